@@ -21,15 +21,21 @@
 # Author: Will Woods <wwoods@redhat.com>
 
 import os, sys, time, platform, shutil
+import threading
 from subprocess import call, check_call, CalledProcessError, Popen, PIPE
 from ConfigParser import NoOptionError
 
-from redhat_upgrade_tool.util import rm_f, mkdir_p
+from redhat_upgrade_tool.util import rm_f, mkdir_p, hrsize
 from redhat_upgrade_tool.download import UpgradeDownloader, YumBaseError, yum_plugin_for_exc, URLGrabError
+from redhat_upgrade_tool.download import format_pkgtup, pkgtup_envra
 from redhat_upgrade_tool.sysprep import prep_upgrade, prep_boot, setup_media_mount, setup_cleanup_post
-from redhat_upgrade_tool.upgrade import RPMUpgrade, TransactionError
+from redhat_upgrade_tool.upgrade import RPMUpgrade, TransactionError, summarize_problems
+from redhat_upgrade_tool.cache import HeaderCache
+from redhat_upgrade_tool.bundle import BundleError
 
 from redhat_upgrade_tool.commandline import parse_args, do_cleanup, device_setup
+from redhat_upgrade_tool.parallel import Phase
+from redhat_upgrade_tool.metrics import metrics
 from redhat_upgrade_tool import textoutput as output
 from redhat_upgrade_tool import upgradeconf
 
@@ -50,12 +56,17 @@ def message(m):
     print m
     log.info(m)
 
-from redhat_upgrade_tool import _, kernelpath, initrdpath
+from redhat_upgrade_tool import _, kernelpath, initrdpath, cachedir
 
 def setup_downloader(version, instrepo=None, cacheonly=False, repos=[],
-                     enable_plugins=[], disable_plugins=[]):
+                     enable_plugins=[], disable_plugins=[],
+                     download_workers=4, mirror_connections=2,
+                     cache_quota=None):
     log.debug("setup_downloader(version=%s, repos=%s)", version, repos)
-    f = UpgradeDownloader(version=version, cacheonly=cacheonly)
+    f = UpgradeDownloader(version=version, cacheonly=cacheonly,
+                          download_workers=download_workers,
+                          mirror_connections=mirror_connections,
+                          cache_quota=cache_quota)
     f.preconf.enabled_plugins += enable_plugins
     f.preconf.disabled_plugins += disable_plugins
     f.instrepoid = instrepo
@@ -72,8 +83,14 @@ def setup_downloader(version, instrepo=None, cacheonly=False, repos=[],
         log.info("disabled repos: " + " ".join(disabled_repos))
     return f
 
-def download_packages(f):
-    updates = f.build_update_transaction(callback=output.DepsolveCallback(f))
+def check_phase(phase):
+    '''if phase has already failed, raise its exception now'''
+    if phase and phase.done():
+        phase.join()
+
+def download_packages(f, images=None):
+    with metrics.phase('depsolve'):
+        updates = f.build_update_transaction(callback=output.DepsolveCallback(f))
     # check for empty upgrade transaction
     if not updates:
         print _('Your system is already upgraded!')
@@ -86,20 +103,59 @@ def download_packages(f):
         for p in transprobs:
             print "  " + p
     # clean out any unneeded packages from the cache
-    f.clean_cache(keepfiles=(p.localPkg() for p in updates))
+    if not args.preflight:
+        f.clean_cache(keepfiles=(p.localPkg() for p in updates))
+    # make sure it's all going to fit before we download anything
+    # --preflight doesn't fetch the boot images at all
+    bootimages = not (args.skipkernel or args.preflight)
+    short = f.plan_disk_space(updates, bootimages=bootimages,
+                              export=bool(args.export_bundle))
+    if short:
+        print _("Not enough free disk space for the upgrade:")
+        for mnt, need, avail in short:
+            print "  " + _("%s needs %s more free space") % (mnt, hrsize(need-avail))
+        if not args.force:
+            print _("Free up some space, or use --force to try anyway.")
+            raise SystemExit(1)
+    # don't download everything just to find out the boot images failed
+    check_phase(images)
     # download packages
-    f.download_packages(updates, callback=output.DownloadCallback())
+    with metrics.phase('download'):
+        f.download_packages(updates, callback=output.DownloadCallback())
 
     return updates
 
-def transaction_test(pkgs):
+def transaction_test(pkgs, headers=None):
     print _("testing upgrade transaction")
     pkgfiles = set(po.localPkg() for po in pkgs)
     fu = RPMUpgrade()
-    probs = fu.setup_transaction(pkgfiles=pkgfiles, check_fatal=False)
-    rv = fu.test_transaction(callback=output.TransactionCallback(numpkgs=len(pkgfiles)))
+    headercache = HeaderCache(os.path.join(cachedir, 'headers.json'),
+                              os.path.join(cachedir, 'headers'))
+    with metrics.phase('transaction_test'):
+        probs = fu.setup_transaction(pkgfiles=pkgfiles, check_fatal=False,
+                                     workers=args.download_workers,
+                                     headercache=headercache,
+                                     headers=headers)
+        rv = fu.test_transaction(callback=output.TransactionCallback(numpkgs=len(pkgfiles)))
     return (probs, rv)
 
+def preflight(pkgs, headers=None):
+    print _("checking upgrade transaction")
+    pkgfiles = set(po.localPkg() for po in pkgs)
+    fu = RPMUpgrade()
+    headercache = HeaderCache(os.path.join(cachedir, 'headers.json'),
+                              os.path.join(cachedir, 'headers'))
+    with metrics.phase('preflight'):
+        return fu.preflight(pkgfiles, workers=args.download_workers,
+                            headercache=headercache, headers=headers)
+
+def timed(phase, func):
+    '''wrap func so its run time gets counted as the given phase'''
+    def wrapper(*args, **kwargs):
+        with metrics.phase(phase):
+            return func(*args, **kwargs)
+    return wrapper
+
 def reboot():
     call(['systemctl', 'reboot'])
 
@@ -116,17 +172,21 @@ def main(args):
         do_cleanup(args)
         return
 
-    if args.device or args.iso:
+    if args.device or args.iso or args.bundle:
         device_setup(args)
 
     # Get our packages set up where we can use 'em
     print _("setting up repos...")
-    f = setup_downloader(version=args.network,
-                         cacheonly=args.cacheonly,
-                         instrepo=args.instrepo,
-                         repos=args.repos,
-                         enable_plugins=args.enable_plugins,
-                         disable_plugins=args.disable_plugins)
+    with metrics.phase('setup_repos'):
+        f = setup_downloader(version=args.network,
+                             cacheonly=args.cacheonly,
+                             instrepo=args.instrepo,
+                             repos=args.repos,
+                             enable_plugins=args.enable_plugins,
+                             disable_plugins=args.disable_plugins,
+                             download_workers=args.download_workers,
+                             mirror_connections=args.mirror_connections,
+                             cache_quota=args.cache_quota)
 
     # Compare the first part of the version number in the treeinfo with the
     # first part of the version number of the system to determine if this is a
@@ -204,12 +264,35 @@ def main(args):
         f.cleanMetadata()
         return
 
-    # Cleanup old conf files
-    log.info("Clearing %s", upgradeconf)
-    rm_f(upgradeconf)
-    mkdir_p(os.path.dirname(upgradeconf))
+    # --preflight only checks things; it doesn't touch the system at all
+    # (so it can't disturb an upgrade that's already set up)
+    if args.preflight:
+        if len(f.pkgSack) == 0:
+            print("no updates available in configured repos!")
+            raise SystemExit(1)
+        pkgs = download_packages(f)
+        problems = preflight(pkgs, f.pkgheaders)
+        if problems:
+            print _("Preflight check found problems:")
+            for s in summarize_problems(problems):
+                print "  "+s.desc
+                for line in s.format_details():
+                    print "    "+line
+            raise SystemExit(1)
+        print _("Finished. Preflight check found no problems.")
+        return
+
+    # Cleanup old conf files (unless we're just exporting a bundle, which
+    # doesn't set up this system for anything)
+    if not args.export_bundle:
+        log.info("Clearing %s", upgradeconf)
+        rm_f(upgradeconf)
+        mkdir_p(os.path.dirname(upgradeconf))
 
     # TODO: error msg generation should be shared between CLI and GUI
+    # The boot images only need .treeinfo, so they get downloaded in the
+    # background while we depsolve and download packages.
+    images = None
     if args.skipkernel:
         message("skipping kernel/initrd download")
     elif f.instrepoid is None or f.instrepoid in f.disabled_repos:
@@ -227,25 +310,55 @@ def main(args):
         raise SystemExit(1)
     else:
         print _("getting boot images...")
-        kernel, initrd = f.download_boot_images() # TODO: force arch?
-
-    if args.skippkgs:
-        message("skipping package download")
-    else:
-        print _("setting up update...")
-        if len(f.pkgSack) == 0:
-            print("no updates available in configured repos!")
-            raise SystemExit(1)
-        pkgs = download_packages(f)
-        # Run a test transaction
-        probs, rv = transaction_test(pkgs)
+        # TODO: force arch?
+        stop = threading.Event()
+        images = Phase('bootimages', timed('boot_images', f.download_boot_images),
+                       kwargs=dict(background=not args.skippkgs,
+                                   export=bool(args.export_bundle),
+                                   source=f.image_source(), cancel=stop),
+                       stop=stop).start()
 
+    try:
+        if args.skippkgs:
+            message("skipping package download")
+        else:
+            print _("setting up update...")
+            if len(f.pkgSack) == 0:
+                print("no updates available in configured repos!")
+                raise SystemExit(1)
+            pkgs = download_packages(f, images)
+            if args.export_bundle:
+                print _("writing upgrade bundle %s") % args.export_bundle
+                try:
+                    f.export_bundle(args.export_bundle, pkgs,
+                                    images=images.join() if images else None)
+                except BundleError as e:
+                    print _("Error: couldn't write upgrade bundle: %s") % e
+                    raise SystemExit(1)
+                print _("Finished. Use --bundle %s to upgrade other systems.") \
+                        % args.export_bundle
+                return
+            check_phase(images)
+            # Run a test transaction
+            probs, rv = transaction_test(pkgs, f.pkgheaders)
+
+        if images:
+            if not images.done():
+                print _("waiting for boot images...")
+            kernel, initrd = images.join()
+    except BaseException:
+        # don't leave it writing to /boot while we exit
+        if images and not images.done():
+            log.info("stopping boot image download")
+            images.cancel()
+        raise
 
     # And prepare for upgrade
     # TODO: use polkit to get root privs for these things
     print _("setting up system for upgrade")
     if not args.skippkgs:
-        prep_upgrade(pkgs)
+        with metrics.phase('prep_upgrade'):
+            prep_upgrade(pkgs)
 
     # Save the repo configuration
     f.save_repo_configs()
@@ -256,7 +369,8 @@ def main(args):
             print "using default paths: %s %s" % (kernelpath, initrdpath)
             kernel = kernelpath
             initrd = initrdpath
-        prep_boot(kernel, initrd)
+        with metrics.phase('prep_boot'):
+            prep_boot(kernel, initrd)
 
     if args.device:
         setup_media_mount(args.device)
@@ -281,11 +395,11 @@ def main(args):
     # --- Here's where we summarize potential problems. ---
 
     # list packages without updates, if any
-    missing = sorted(f.find_packages_without_updates(), key=lambda p:p.envra)
+    missing = f.find_packages_without_updates()
     if missing and not major_upgrade:
         message(_('Packages without updates:'))
-        for p in missing:
-            message("  %s" % p)
+        for pkgtup in sorted(missing, key=pkgtup_envra):
+            message("  %s" % format_pkgtup(pkgtup))
 
     # warn if the "important" repos are disabled
     #if f.disabled_repos:
@@ -368,4 +482,6 @@ if __name__ == '__main__':
         exittype = "with unhandled exception"
         raise
     finally:
+        if args.metrics_dir:
+            metrics.write(args.metrics_dir)
         log.info("%s exiting %s at %s", sys.argv[0], exittype, time.asctime())
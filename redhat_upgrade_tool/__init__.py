@@ -45,6 +45,7 @@ kernelpath = '/boot/vmlinuz-%s' % kernel_id
 initrdpath = '/boot/initramfs-%s.img' % kernel_id
 
 cachedir = '/var/tmp/system-upgrade'
+bundledir = cachedir + '/bundle'
 packagedir = '/var/lib/system-upgrade'
 packagelist = packagedir + '/package.list'
 upgradeconf = packagedir + '/upgrade.conf'
@@ -0,0 +1,210 @@
+# bundle.py - pack everything needed for an upgrade into a single file
+#
+# Copyright (C) 2026 The redhat-upgrade-tool contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+An upgrade bundle is a tar archive that holds everything a host needs to
+prepare the upgrade without touching the network:
+
+  bundle.json              manifest (see below)
+  repos/$REPOID/repodata/  the metadata yum used for each enabled repo
+  repos/$REPOID/...        the packages from that repo, at their usual paths
+  repos/$INSTREPO/.treeinfo (and .treeinfo.signed, kernel, upgrade image)
+  keys/...                 GPG keys for the repos
+
+After unpacking, each repo directory gets added like a --device repo would be
+(i.e. --addrepo bundle-$REPOID=file://...).
+
+A bundle can only be used on a host with the same arch, and it refuses to
+add a repo that had gpgcheck turned on but has no keys.
+
+GPG keys are only trusted if they were installed by a trusted package (see
+UpgradeDownloader.check_keyfile), which the copies in the bundle never are.
+So each key's original location is kept in the manifest, and if the host
+has its own copy of the key there, that gets used instead. Otherwise the
+bundled copy is used, and packages or .treeinfo signed with that key will
+fail verification unless the key is already trusted by rpm on the host.
+'''
+
+import os
+import re
+import json
+import tarfile
+import urllib2
+from StringIO import StringIO
+
+from .util import mkdir_p, rm_rf
+
+import logging
+log = logging.getLogger(__package__+".bundle")
+
+FORMAT = 1
+MANIFEST = 'bundle.json'
+REPO_PREFIX = 'bundle-'
+
+class BundleError(Exception):
+    pass
+
+class BundleWriter(object):
+    '''Writes a bundle. Use it as a context manager; the bundle only appears
+    at 'filename' if everything was written successfully.'''
+    def __init__(self, filename, version=None, arch=None):
+        self.filename = filename
+        self.tmpname = filename + '.partial'
+        self.manifest = {'format': FORMAT, 'version': version, 'arch': arch,
+                         'instrepo': None, 'images': {}, 'repos': []}
+        self.tar = None
+
+    def __enter__(self):
+        self.tar = tarfile.open(self.tmpname, 'w')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        ok = False
+        try:
+            if exc_type is None:
+                self._check()
+                self._add_manifest()
+                ok = True
+        finally:
+            self.tar.close()
+            if ok:
+                os.rename(self.tmpname, self.filename)
+            else:
+                os.remove(self.tmpname)
+
+    def _check(self):
+        for repo in self.manifest['repos']:
+            if repo['gpgcheck'] and not repo['gpgkey']:
+                raise BundleError("repo %s has gpgcheck enabled but no GPG "
+                                  "keys" % repo['id'])
+
+    def _add_manifest(self):
+        data = json.dumps(self.manifest, indent=1)
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(data)
+        self.tar.addfile(info, StringIO(data))
+
+    def add_file(self, path, arcname):
+        log.debug("adding %s as %s", path, arcname)
+        self.tar.add(path, arcname, recursive=False)
+
+    def add_repo(self, repoid, gpgcheck=False):
+        ent = {'id': repoid, 'gpgcheck': gpgcheck, 'gpgkey': []}
+        self.manifest['repos'].append(ent)
+        return ent
+
+    def add_key(self, repo, keyurl):
+        '''copy the GPG key at keyurl into the bundle. Raises BundleError
+        if that fails and the repo has gpgcheck enabled.'''
+        arcname = 'keys/%s-%u-%s' % (repo['id'], len(repo['gpgkey']),
+                                     os.path.basename(keyurl))
+        try:
+            if keyurl.startswith('file://'):
+                self.add_file(keyurl[7:], arcname)
+            else:
+                data = urllib2.urlopen(keyurl, timeout=30).read()
+                info = tarfile.TarInfo(arcname)
+                info.size = len(data)
+                self.tar.addfile(info, StringIO(data))
+        except (IOError, OSError, urllib2.URLError) as e:
+            if repo['gpgcheck']:
+                raise BundleError("couldn't add key %s for repo %s: %s" %
+                                  (keyurl, repo['id'], e))
+            log.warn("couldn't add key %s to bundle: %s", keyurl, e)
+            return
+        repo['gpgkey'].append({'url': keyurl, 'file': arcname})
+
+def host_arch():
+    '''the arch of this host, the way .treeinfo spells it'''
+    arch = os.uname()[4]
+    if re.match(r'i[3-6]86$', arch):
+        return 'i386'
+    return arch
+
+def read_manifest(filename):
+    try:
+        with tarfile.open(filename) as tar:
+            return json.load(tar.extractfile(MANIFEST))
+    except (IOError, OSError, KeyError, ValueError, tarfile.TarError) as e:
+        raise BundleError(str(e))
+
+def unpack(filename, destdir, version=None, arch=None):
+    '''
+    Unpack the bundle into destdir (unless it's already there) and return
+    (repos, instrepo): the --addrepo-style actions to add its repos and the
+    id of the repo with the boot images.
+    Raises BundleError if the bundle wasn't made for the given version
+    (if any) and arch (default: this host's arch).
+    '''
+    manifest = read_manifest(filename)
+    if manifest.get('format') != FORMAT:
+        raise BundleError("unknown bundle format %s" % manifest.get('format'))
+    arch = arch or host_arch()
+    if manifest.get('arch') != arch:
+        raise BundleError("bundle is for arch %s, not %s" %
+                          (manifest.get('arch'), arch))
+    if version and manifest.get('version') != version:
+        raise BundleError("bundle is for version %s, not %s" %
+                          (manifest.get('version'), version))
+    for repo in manifest['repos']:
+        if repo['gpgcheck'] and not repo['gpgkey']:
+            raise BundleError("repo %s has gpgcheck enabled but no GPG keys"
+                              % repo['id'])
+    st = os.stat(filename)
+    stamp = [os.path.abspath(filename), st.st_size, st.st_mtime]
+    stampfile = os.path.join(destdir, '.bundle-stamp')
+    try:
+        with open(stampfile) as inf:
+            unpacked = (json.load(inf) == stamp)
+    except (IOError, ValueError):
+        unpacked = False
+
+    if unpacked:
+        log.info("bundle %s already unpacked in %s", filename, destdir)
+    else:
+        log.info("unpacking bundle %s to %s", filename, destdir)
+        rm_rf(destdir)
+        mkdir_p(destdir)
+        try:
+            with tarfile.open(filename) as tar:
+                for member in tar:
+                    name = os.path.normpath(member.name)
+                    if name.startswith(('/', '..')) or \
+                            not (member.isfile() or member.isdir()):
+                        raise BundleError("bad file in bundle: %s" % member.name)
+                    tar.extract(member, destdir)
+        except (IOError, OSError, tarfile.TarError) as e:
+            raise BundleError(str(e))
+        with open(stampfile, 'w') as outf:
+            json.dump(stamp, outf)
+
+    repos = []
+    for repo in manifest['repos']:
+        # (JSON gives us unicode, but yum wants plain strings)
+        repoid = REPO_PREFIX + str(repo['id'])
+        repodir = os.path.join(destdir, 'repos', str(repo['id']))
+        repos.append(('add', '%s=file://%s' % (repoid, repodir)))
+        for key in repo['gpgkey']:
+            url = str(key['url'])
+            if not (url.startswith('file://') and os.path.exists(url[7:])):
+                log.warn("%s isn't on this system; using the copy from the "
+                         "bundle, which won't be trusted automatically", url)
+                url = 'file://' + os.path.join(destdir, str(key['file']))
+            repos.append(('gpgkey', '%s=%s' % (repoid, url)))
+    instrepo = manifest['instrepo']
+    if instrepo:
+        instrepo = REPO_PREFIX + str(instrepo)
+    return repos, instrepo
@@ -0,0 +1,375 @@
+# cache.py - persistent indexes and other bookkeeping for cachedir
+#
+# Copyright (C) 2026 The redhat-upgrade-tool contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import zlib
+import hashlib
+import threading
+from tempfile import mkstemp
+
+from .util import mkdir_p, rm_f
+
+import logging
+log = logging.getLogger(__package__+".cache")
+
+def statkey(st):
+    '''the parts of a stat result that tell us if a file has changed'''
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime]
+
+class JSONCache(object):
+    '''A dict that gets loaded from / saved to a JSON file.
+    A missing or corrupt file just gives you an empty cache.'''
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.dirty = False
+        self.data = self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as inf:
+                data = json.load(inf)
+            if isinstance(data, dict):
+                return data
+        except (IOError, ValueError) as e:
+            log.debug("not using %s: %s", self.filename, e)
+        return dict()
+
+    def save(self):
+        '''Write the cache to disk (atomically), if it's changed.'''
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                d = os.path.dirname(self.filename)
+                mkdir_p(d)
+                fd, tmp = mkstemp(dir=d, prefix='.'+os.path.basename(self.filename))
+                with os.fdopen(fd, 'w') as outf:
+                    json.dump(self.data, outf)
+                os.rename(tmp, self.filename)
+                self.dirty = False
+            except (IOError, OSError) as e:
+                log.warn("couldn't write %s: %s", self.filename, str(e))
+
+    def clear(self):
+        with self.lock:
+            self.data = dict()
+            self.dirty = True
+
+class VerifiedIndex(JSONCache):
+    '''
+    Remembers the checksums of files we've already verified, along with
+    enough of their stat info to tell if they've changed since then.
+
+    Each entry is: filename: [dev, ino, size, mtime, algo, hexdigest]
+    '''
+    def check(self, filename, algo, digest):
+        '''
+        If filename was recorded with the given checksum and hasn't changed
+        since, return its current stat result. Otherwise return None.
+        '''
+        with self.lock:
+            ent = self.data.get(filename)
+        if not ent or ent[4:] != [algo, digest]:
+            return None
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        if statkey(st) != ent[:4]:
+            return None
+        return st
+
+    def record(self, filename, algo, digest, st=None):
+        '''
+        Record that filename has the given checksum. st should be the stat
+        result from *before* the file was read, if you've got it.
+        '''
+        try:
+            st = st or os.stat(filename)
+        except OSError:
+            return
+        with self.lock:
+            self.data[filename] = statkey(st) + [algo, digest]
+            self.dirty = True
+
+    def forget(self, filename):
+        with self.lock:
+            if self.data.pop(filename, None):
+                self.dirty = True
+
+class KeyTrustCache(JSONCache):
+    '''
+    Remembers whether we decided to trust a GPG key file.
+
+    Each entry is: keyfile: [sha256 digest, owning package NEVRA, trusted]
+
+    The whole cache belongs to one state of the rpmdb (identified by an
+    rpmdb "cookie"): if the rpmdb changes, the package that owns a keyfile
+    (or the keys rpm trusts) might have changed too, so everything gets
+    thrown out. Within one rpmdb state, a keyfile with the same digest
+    always gets the same answer.
+    '''
+    def __init__(self, filename, cookie):
+        JSONCache.__init__(self, filename)
+        if cookie is None or self.data.get('cookie') != cookie or \
+                'keys' not in self.data:
+            log.debug("rpmdb has changed; forgetting key trust decisions")
+            self.data = {'cookie': cookie, 'keys': {}}
+            self.dirty = True
+
+    def get(self, keyfile, digest):
+        '''Return (owner, trusted) if we've seen this keyfile, or None.'''
+        with self.lock:
+            ent = self.data['keys'].get(keyfile)
+        if ent and ent[0] == digest:
+            return ent[1], ent[2]
+        return None
+
+    def set(self, keyfile, digest, owner, trusted):
+        with self.lock:
+            self.data['keys'][keyfile] = [digest, owner, trusted]
+            self.dirty = True
+
+class PartialJournal(JSONCache):
+    '''
+    Keeps track of partially-downloaded files and what they're supposed to
+    turn into, so an interrupted download can be resumed (with a HTTP Range
+    request) instead of starting over.
+
+    Each entry is: filename: [url, algo, hexdigest]
+    '''
+    def start(self, filename, url, algo, digest):
+        '''
+        Note that we're starting a download of url to filename.
+        Returns True if any partial data already at filename (or in pieces
+        next to it) belongs to the same download and can be resumed.
+        Otherwise any existing file is removed and False is returned.
+        '''
+        with self.lock:
+            if self.data.get(filename) == [url, algo, digest]:
+                log.debug("resuming partial download %s", filename)
+                return True
+            rm_f(filename)
+            self.data[filename] = [url, algo, digest]
+            self.dirty = True
+            return False
+
+    def finish(self, filename):
+        '''Note that filename is complete (or gone).'''
+        with self.lock:
+            if self.data.pop(filename, None):
+                self.dirty = True
+
+class DepsolveCache(JSONCache):
+    '''
+    Remembers the result of the last depsolve, along with a key describing
+    everything that went into it (rpmdb state, repo metadata, plugins, etc).
+    If the key matches next time, the result can be used instead of
+    depsolving all over again.
+
+    The result is a dict with two items:
+      members:  [[pkgtup, repoid, output_state, ts_state, current_state,
+                  isDep, reason, [[pkgtup, repoid, relation], ...]], ...]
+      problems: [[pkgtup, repoid, pkgtup, repoid, errmsg], ...]
+    '''
+    def get(self, key):
+        '''Return the saved result if it was made with the given key.'''
+        if key is None:
+            return None
+        # compare it the way it'll look after a trip through JSON
+        key = json.loads(json.dumps(key))
+        with self.lock:
+            if self.data.get('key') == key:
+                return self.data.get('result')
+        return None
+
+    def set(self, key, result):
+        with self.lock:
+            self.data = {'key': key, 'result': result}
+            self.dirty = True
+
+class CacheIndex(JSONCache):
+    '''
+    Keeps track of the size of each package in the cache and when it was
+    last used, so the cache can be trimmed without scanning it.
+
+    Each entry is: filename: [size, last used]
+
+    The cache gets scanned once, when the index is first created. After
+    that the index is updated as files are added and removed.
+
+    Files under the directories in exclude (like an unpacked bundle, which
+    isn't ours to trim) are never indexed.
+    '''
+    def __init__(self, filename, topdir, exclude=()):
+        JSONCache.__init__(self, filename)
+        self.exclude = tuple(d.rstrip('/') + '/' for d in exclude)
+        if not isinstance(self.data.get('files'), dict):
+            log.info("indexing packages in %s", topdir)
+            self.data = {'files': self.scan(topdir, self.exclude)}
+            self.dirty = True
+        self.files = self.data['files']
+        for f in [f for f in self.files if f.startswith(self.exclude)]:
+            del self.files[f]
+            self.dirty = True
+        self.total = sum(ent[0] for ent in self.files.values())
+
+    @staticmethod
+    def scan(topdir, exclude=()):
+        files = dict()
+        for root, dirs, names in os.walk(topdir):
+            dirs[:] = [d for d in dirs
+                       if not os.path.join(root, d, '').startswith(exclude)]
+            for name in names:
+                if not name.endswith('.rpm'):
+                    continue
+                f = os.path.join(root, name)
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                files[f] = [st.st_size, st.st_mtime]
+        return files
+
+    def add(self, filename, size=None):
+        '''Note that filename is in the cache (and was just used).'''
+        if filename.startswith(self.exclude):
+            return
+        try:
+            size = size if size is not None else os.path.getsize(filename)
+        except OSError:
+            return
+        with self.lock:
+            old = self.files.get(filename)
+            self.total += size - (old[0] if old else 0)
+            self.files[filename] = [size, time.time()]
+            self.dirty = True
+
+    def touch(self, filename):
+        '''Note that filename was just used.'''
+        with self.lock:
+            if filename in self.files:
+                self.files[filename][1] = time.time()
+                self.dirty = True
+
+    def forget(self, filename):
+        with self.lock:
+            ent = self.files.pop(filename, None)
+            if ent:
+                self.total -= ent[0]
+                self.dirty = True
+
+    def remove(self, filename):
+        '''Delete filename and forget about it.'''
+        log.debug("removing %s", filename)
+        rm_f(filename)
+        if not os.path.lexists(filename):
+            self.forget(filename)
+            return True
+        return False
+
+    def trim(self, quota, keep=()):
+        '''
+        Remove the least recently used files until the cache is no bigger
+        than quota bytes. Files in keep are never removed.
+        Returns the list of removed files.
+        '''
+        keep = set(keep)
+        with self.lock:
+            lru = sorted((ent[1], f) for f, ent in self.files.items()
+                                    if f not in keep)
+        removed = []
+        for used, f in lru:
+            if self.total <= quota:
+                break
+            if self.remove(f):
+                removed.append(f)
+        if self.total > quota:
+            log.info("cache is still %u bytes over quota", self.total - quota)
+        return removed
+
+class HeaderCache(JSONCache):
+    '''
+    Keeps a copy of the RPM header of each package in the cache, so the
+    transaction test doesn't have to read them all out of the packages
+    again every time.
+
+    The headers themselves are stored (zlib-compressed) in 'blobdir'; the
+    index just says which package each blob came from.
+
+    Each entry is: filename: [dev, ino, size, mtime, blobname]
+    '''
+    def __init__(self, filename, blobdir):
+        JSONCache.__init__(self, filename)
+        self.blobdir = blobdir
+
+    def _blobname(self, filename):
+        return hashlib.sha1(filename).hexdigest() + '.hdr'
+
+    def get(self, filename):
+        '''Return the header data for filename, or None if it's not cached
+        (or the package has changed since it was).'''
+        with self.lock:
+            ent = self.data.get(filename)
+        if not ent:
+            return None
+        try:
+            if statkey(os.stat(filename)) != ent[:4]:
+                return None
+            with open(os.path.join(self.blobdir, ent[4]), 'rb') as inf:
+                return zlib.decompress(inf.read())
+        except (IOError, OSError, zlib.error) as e:
+            log.debug("cached header for %s unusable: %s", filename, e)
+            return None
+
+    def has(self, filename):
+        '''True if there's a header for filename and it's still valid.'''
+        with self.lock:
+            ent = self.data.get(filename)
+        try:
+            return bool(ent) and statkey(os.stat(filename)) == ent[:4]
+        except OSError:
+            return False
+
+    def put(self, filename, blob, st=None):
+        '''Save the header data for filename. st should be the stat result
+        from *before* the header was read, if you've got it.'''
+        try:
+            st = st or os.stat(filename)
+            mkdir_p(self.blobdir)
+            blobname = self._blobname(filename)
+            fd, tmp = mkstemp(dir=self.blobdir, prefix='.'+blobname)
+            with os.fdopen(fd, 'wb') as outf:
+                outf.write(zlib.compress(blob, 1))
+            os.rename(tmp, os.path.join(self.blobdir, blobname))
+        except (IOError, OSError) as e:
+            log.debug("couldn't cache header for %s: %s", filename, e)
+            return
+        with self.lock:
+            self.data[filename] = statkey(st) + [blobname]
+            self.dirty = True
+
+    def prune(self, keep):
+        '''Throw out the headers of every package not in keep.'''
+        keep = set(keep)
+        with self.lock:
+            for f in [f for f in self.data if f not in keep]:
+                rm_f(os.path.join(self.blobdir, self.data.pop(f)[4]))
+                self.dirty = True
@@ -101,6 +101,11 @@ class DownloadCallbackBase(ProcessTransBaseCallback):
         shortname = filename.split('/')[-1]
         self.log.debug("verifying %u/%u %s", amount, total, shortname)
 
+    # our 'download' callback for the concurrent downloader
+    def download(self, amount, total, filename, data):
+        shortname = filename.split('/')[-1]
+        self.log.debug("downloaded %u/%u %s", amount, total, shortname)
+
 # callback object for depsolving
 
 class DepsolveCallbackBase(object):
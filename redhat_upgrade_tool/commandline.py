@@ -17,9 +17,11 @@
 #
 # Author: Will Woods <wwoods@redhat.com>
 
-import os, argparse, platform
+import os, re, argparse, platform
 
 from . import media
+from . import bundle
+from . import bundledir
 from .sysprep import reset_boot, remove_boot, remove_cache, misc_cleanup
 from . import _
 
@@ -41,7 +43,8 @@ def parse_args(gui=False):
     p.set_defaults(loglevel=logging.WARNING)
 
     p.add_argument('-f', '--force', action='store_true', default=False,
-            help=_('continue even if preupgrade-assistant risk check fails'))
+            help=_('continue even if the preupgrade-assistant risk check, '
+                   'the variant check or the disk space check fails'))
     p.add_argument('--cleanup-post', action='store_true', default=False,
             help=_('cleanup old package after the upgrade'))
 
@@ -51,6 +54,17 @@ def parse_args(gui=False):
     p.add_argument('--reboot', action='store_true', default=False,
         help=_('automatically reboot to start the upgrade when ready'))
 
+    p.add_argument('--export-bundle', metavar='FILE',
+        help=_('write packages, metadata and boot images to FILE for '
+               'offline upgrades (with --bundle)'))
+
+    p.add_argument('--preflight', action='store_true', default=False,
+        help=_('just do quick checks (dependencies, file conflicts, disk '
+               'space) and exit without setting up the upgrade'))
+
+    p.add_argument('--metrics-dir', metavar='DIR',
+        help=_('write download/timing metrics (JSON and Prometheus) to DIR'))
+
 
     # === hidden options. FOR DEBUGGING ONLY. ===
     p.add_argument('--skippkgs', action='store_true', default=False,
@@ -86,6 +100,8 @@ def parse_args(gui=False):
     # Translators: This is for '--network [VERSION]' in --help output
     req.add_argument('--network', metavar=_('VERSION'), type=VERSION,
         help=_('online repos matching VERSION (a number or "rawhide")'))
+    req.add_argument('--bundle', metavar='FILE', type=bundlefile,
+        help=_('upgrade bundle made with --export-bundle'))
 
 
     # === options for --network ===
@@ -99,6 +115,12 @@ def parse_args(gui=False):
         help=_('add the repo at URL (@URL for mirrorlist)'))
     net.add_argument('--instrepo', metavar='REPOID', type=str,
         help=_('get upgrader boot images from REPOID (default: auto)'))
+    net.add_argument('--download-workers', metavar='N', type=int, default=4,
+        help=_('number of packages to download at once (default: 4)'))
+    net.add_argument('--mirror-connections', metavar='N', type=int, default=2,
+        help=_('max connections to each mirror (default: 2)'))
+    net.add_argument('--cache-quota', metavar='SIZE', type=SIZE,
+        help=_('keep old packages in the cache, up to SIZE (e.g. 4G)'))
     p.set_defaults(repos=[])
 
     if not gui:
@@ -116,8 +138,9 @@ def parse_args(gui=False):
 
     args = p.parse_args()
 
-    if not (gui or args.network or args.device or args.iso or args.clean):
-        p.error(_('SOURCE is required (--network, --device, --iso)'))
+    if not (gui or args.network or args.device or args.iso or args.bundle
+            or args.clean):
+        p.error(_('SOURCE is required (--network, --device, --iso, --bundle)'))
 
     # allow --instrepo URL as shorthand for --repourl REPO=URL --instrepo REPO
     if args.instrepo and '://' in args.instrepo:
@@ -128,6 +151,12 @@ def parse_args(gui=False):
     if args.network and not args.instrepo:
         p.error(_('--instrepo is required with --network'))
 
+    if args.preflight and args.export_bundle:
+        p.error(_('--preflight and --export-bundle can\'t be used together'))
+
+    if args.skippkgs and args.export_bundle:
+        p.error(_('--skippkgs and --export-bundle can\'t be used together'))
+
     if not gui:
         if args.clean:
             args.resetbootloader = True
@@ -186,6 +215,16 @@ def isofile(arg):
             "Copy the image to your hard drive or burn it to a disk."))
     return arg
 
+def bundlefile(arg):
+    if not os.path.isfile(arg):
+        raise argparse.ArgumentTypeError(_("File not found: %s") % arg)
+    try:
+        bundle.read_manifest(arg)
+    except bundle.BundleError as e:
+        raise argparse.ArgumentTypeError(_("Not an upgrade bundle: %s: %s")
+                                         % (arg, e))
+    return arg
+
 def VERSION(arg):
     if arg.lower() == 'rawhide':
         return 'rawhide'
@@ -199,6 +238,13 @@ def VERSION(arg):
         msg = _("version must be greater than %i") % version
         raise argparse.ArgumentTypeError(msg)
 
+def SIZE(arg):
+    m = re.match(r'^(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?$', arg.strip(), re.I)
+    if not m:
+        raise argparse.ArgumentTypeError(_("invalid size: %s") % arg)
+    num, unit = m.groups()
+    return int(float(num) * 1024**' KMGT'.index(unit.upper() or ' '))
+
 def do_cleanup(args):
     if not args.skipbootloader:
         print "resetting bootloader config"
@@ -229,3 +275,14 @@ def device_setup(args):
         else:
             args.repos.append(('add', 'upgradeiso=file://%s' % args.device.mnt))
             args.instrepo = 'upgradeiso'
+    if args.bundle:
+        # treat --bundle like --addrepo REPO=file://... for each repo in it
+        try:
+            repos, instrepo = bundle.unpack(args.bundle, bundledir,
+                                            version=args.network)
+        except (bundle.BundleError, IOError, OSError) as e:
+            log.info("bundle unpack failure: %s", e)
+            print '--bundle: '+_('Unable to open %s: %s') % (args.bundle, e)
+            raise SystemExit(2)
+        args.repos += repos
+        args.instrepo = args.instrepo or instrepo
@@ -0,0 +1,131 @@
+# diskspace.py - figure out if the upgrade will fit before we start it
+#
+# Copyright (C) 2026 The redhat-upgrade-tool contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import rpm
+from yum.constants import TS_INSTALL_STATES, TS_REMOVE_STATES
+
+from . import media
+from .util import df
+
+import logging
+log = logging.getLogger(__package__+".diskspace")
+
+class DiskPlan(object):
+    '''
+    Adds up how much space we're going to need on each mounted filesystem.
+    Sizes can be negative (e.g. for files that will be removed).
+    '''
+    def __init__(self, mounts=None):
+        if mounts is None:
+            mounts = [m.mnt for m in media.mounts()]
+        # longest first, so the first match is the right one
+        self.mounts = sorted(set(mounts), key=len, reverse=True)
+        self.needs = dict()
+        self._dircache = dict()
+
+    def mountpoint(self, path):
+        '''the mountpoint of the filesystem path is (or would be) on'''
+        d = os.path.dirname(path)
+        if d not in self._dircache:
+            for mnt in self.mounts:
+                if d == mnt or d.startswith(mnt.rstrip('/') + '/'):
+                    self._dircache[d] = mnt
+                    break
+            else:
+                self._dircache[d] = '/'
+        return self._dircache[d]
+
+    def add(self, path, size):
+        mnt = self.mountpoint(path)
+        self.needs[mnt] = self.needs.get(mnt, 0) + size
+
+    def shortfalls(self):
+        '''
+        Return a list of (mountpoint, needed, available) for each filesystem
+        that doesn't have enough free space.
+        '''
+        short = []
+        for mnt, need in sorted(self.needs.items()):
+            if need <= 0:
+                continue
+            try:
+                avail = df(mnt)
+            except OSError as e:
+                log.info("can't check free space on %s: %s", mnt, e)
+                continue
+            log.info("%s needs %u bytes, %u available", mnt, need, avail)
+            if need > avail:
+                short.append((mnt, need, avail))
+        return short
+
+def plan_install(tsInfo, plan):
+    '''
+    Estimate how the installed size of each filesystem will change.
+
+    The metadata only gives us the total installed size of each new package,
+    so we spread it over the filesystems the same way the files of the
+    package(s) it replaces are spread (according to the rpmdb). Brand new
+    packages are assumed to go wherever /usr is.
+    '''
+    usage = dict()
+    def old_usage(po):
+        if po.pkgtup not in usage:
+            u = dict()
+            try:
+                hdr = po.hdr
+                for name, size in zip(hdr[rpm.RPMTAG_FILENAMES],
+                                      hdr[rpm.RPMTAG_FILESIZES]):
+                    mnt = plan.mountpoint(name)
+                    u[mnt] = u.get(mnt, 0) + size
+            except (AttributeError, KeyError, TypeError) as e:
+                log.debug("no file info for %s: %s", po, e)
+            usage[po.pkgtup] = u
+        return usage[po.pkgtup]
+
+    for txmbr in tsInfo.getMembers():
+        if txmbr.output_state in TS_INSTALL_STATES:
+            old = dict()
+            for opo in txmbr.updates + txmbr.obsoletes:
+                for mnt, size in old_usage(opo).items():
+                    old[mnt] = old.get(mnt, 0) + size
+            total = sum(old.values())
+            newsize = int(txmbr.po.installedsize or 0)
+            if not total:
+                plan.add('/usr/', newsize)
+                continue
+            for mnt, size in old.items():
+                plan.needs[mnt] = plan.needs.get(mnt, 0) + newsize*size/total
+        elif txmbr.output_state in TS_REMOVE_STATES:
+            for mnt, size in old_usage(txmbr.po).items():
+                plan.needs[mnt] = plan.needs.get(mnt, 0) - size
+    return plan
+
+def plan_headers(installs, removes, plan):
+    '''
+    Work out how the space used on each filesystem will change if the
+    packages with the headers in installs replace the ones in removes.
+    Unlike plan_install this uses the real size of every file.
+    '''
+    for hdrs, sign in ((installs, 1), (removes, -1)):
+        for hdr in hdrs:
+            for name, size, flags in zip(hdr[rpm.RPMTAG_FILENAMES],
+                                         hdr[rpm.RPMTAG_FILESIZES],
+                                         hdr[rpm.RPMTAG_FILEFLAGS]):
+                if not flags & rpm.RPMFILE_GHOST:
+                    plan.add(name, sign*size)
+    return plan
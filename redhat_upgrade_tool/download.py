@@ -18,26 +18,47 @@
 # Author: Will Woods <wwoods@redhat.com>
 
 import os
+import rpm
 import yum
+import time
+import hashlib
 import struct
 import logging
+import threading
 from .callback import BaseTsCallback
-from .treeinfo import Treeinfo, TreeinfoError
+from .treeinfo import Treeinfo, TreeinfoError, hexdigest
 from .conf import Config
 from yum.Errors import YumBaseError
 from yum.parser import varReplace
 from yum.constants import TS_REMOVE_STATES
-from urlgrabber.grabber import URLGrabError
+from yum.transactioninfo import TransactionMember
+from urlgrabber.grabber import URLGrabber, URLGrabError
+from urlgrabber.mirror import MirrorGroup, MGRandomOrder
 from yum.misc import gpgme
+from rpmUtils.miscutils import getSigInfo
+from StringIO import StringIO
+from collections import namedtuple
 
 enabled_plugins = ['blacklist', 'whiteout']
 disabled_plugins = ['rpm-warm-cache', 'remove-with-leaves', 'presto',
                     'auto-update-debuginfo', 'refresh-packagekit']
 
 from . import _
-from . import cachedir, upgradeconf, kernelpath, initrdpath, defaultkey
+from . import cachedir, packagedir, upgradeconf, kernelpath, initrdpath, defaultkey
+from . import bundledir
 from . import mirrormanager
-from .util import listdir, mkdir_p, rm_rf
+from .util import mkdir_p, rm_f, rm_rf
+from .fetch import PackageFetcher, DownloadPipeline, MirrorSlots, is_remote
+from .fetch import remote_size, fetch_segmented, fetch_hashed, remove_segments
+from .fetch import Cancelled
+from .cache import JSONCache, VerifiedIndex, KeyTrustCache, PartialJournal
+from .cache import DepsolveCache, CacheIndex
+from .diskspace import DiskPlan, plan_install
+from .bundle import BundleWriter, BundleError
+from .metrics import metrics
+from .mirrors import MirrorScoreboard, probe_mirrors, mirror_host, is_network_url
+from .parallel import pmap, process_map, checksum_file, threadsafe_urlgrabber
+from multiprocessing import cpu_count
 from shutil import copy2
 
 log = logging.getLogger(__package__+".yum") # maybe I should rename this..
@@ -72,19 +93,144 @@ def init_keyring(gpgdir):
         os.chmod(gpgdir, 0o700)
     os.environ['GNUPGHOME'] = gpgdir
 
-def import_key(keydata, hexkeyid, gpgdir):
-    log.debug("importing key %s", hexkeyid.lower())
-    yum.misc.import_key_to_pubring(keydata, hexkeyid,
-                                   gpgdir=gpgdir, make_ro_copy=False)
+def import_keys(keys, gpgdir):
+    '''Import a list of armored keys into the keyring in one go, and mark
+    them trusted (like yum.misc.import_key_to_pubring does).'''
+    if not keys:
+        return
+    import gpgme.editutil
+    log.debug("importing %u keys", len(keys))
+    os.environ['GNUPGHOME'] = gpgdir
+    ctx = gpgme.Context()
+    result = ctx.import_(StringIO('\n'.join(keys)))
+    for fpr, err, status in result.imports:
+        if err:
+            log.info("failed to import key %s: %s", fpr, err)
+            continue
+        gpgme.editutil.edit_trust(ctx, ctx.get_key(fpr),
+                                  gpgme.VALIDITY_ULTIMATE)
+
+def delete_keys(hexkeyids, gpgdir):
+    '''Remove the keys with the given (rpm-style) IDs from the keyring.'''
+    hexkeyids = set(k.lower() for k in hexkeyids)
+    os.environ['GNUPGHOME'] = gpgdir
+    ctx = gpgme.Context()
+    for key in list(ctx.keylist()):
+        if key.subkeys[0].keyid[-8:].lower() in hexkeyids:
+            log.debug("removing key %s", key.subkeys[0].keyid)
+            ctx.delete(key)
+
+def pkgtup_envra(pkgtup):
+    '''the envra string for a (name, arch, epoch, version, release) tuple'''
+    n, a, e, v, r = pkgtup
+    return '%s:%s-%s-%s.%s' % (e, n, v, r, a)
+
+def format_pkgtup(pkgtup):
+    '''format a pkgtup the way yum formats a package (leaving out epoch 0)'''
+    n, a, e, v, r = pkgtup
+    if e in ('0', None):
+        return '%s-%s-%s.%s' % (n, v, r, a)
+    return pkgtup_envra(pkgtup)
+
+def rpmdb_cookie(root='/'):
+    '''something that changes whenever the rpmdb does'''
+    dbpath = os.path.join(root, rpm.expandMacro('%_dbpath').lstrip('/'))
+    try:
+        st = os.stat(os.path.join(dbpath, 'Packages'))
+        return [st.st_ino, st.st_size, st.st_mtime]
+    except OSError:
+        return None
+
+def keystamp(url, cookie):
+    '''
+    [sha256 digest, rpmdb cookie] for file:// urls. Whether we trust a key
+    file depends on its contents and the rpmdb, so if the stamp changes
+    the key has to be checked again. None means "always check it".
+    '''
+    if url.startswith('file://') and cookie is not None:
+        try:
+            return [hexdigest(url[7:], 'sha256'), cookie]
+        except IOError:
+            pass
+    return None
 
 def list_keyring(gpgdir):
     return [yum.misc.keyIdToRPMVer(int(k, 16))
             for k in yum.misc.return_keyids_from_pubring(gpgdir)]
 
 
+_tls = threading.local()
+_sigerrors = {
+    "public key not availaiable": 1, # sic - rpm really said this once
+    "public key not available": 1,
+    "public key not trusted": 3,
+    "error reading package header": 2,
+}
+def checksig(filename, sigcheck=True):
+    '''
+    Like rpmUtils.miscutils.checkSig, but safe to call from worker threads
+    (each thread gets its own transaction set) and it returns the header,
+    too. If sigcheck is False, just read the header. Returns (value, hdr),
+    where value is:
+
+      0: signatures OK, 1: key not found, 2: damaged or bad signature,
+      3: key not trusted, 4: package not signed
+
+    and hdr is the package header (or None if it couldn't be read).
+    For a package whose key isn't found or trusted, hdr is read without
+    checking the signature, so the caller can still see who signed it.
+    '''
+    ts = getattr(_tls, 'ts', None)
+    if ts is None:
+        ts = _tls.ts = rpm.TransactionSet('/')
+    ts.setVSFlags(0 if sigcheck else rpm._RPMVSF_NOSIGNATURES)
+    value, hdr = 0, None
+    fdno = os.open(filename, os.O_RDONLY)
+    try:
+        hdr = ts.hdrFromFdno(fdno)
+    except rpm.error as e:
+        value = _sigerrors.get(str(e), 2)
+        if value in (1, 3):
+            try:
+                os.lseek(fdno, 0, 0)
+                ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+                hdr = ts.hdrFromFdno(fdno)
+            except rpm.error:
+                pass
+    else:
+        if sigcheck and getSigInfo(hdr)[0] == 101:
+            value = 4
+    finally:
+        os.close(fdno)
+    return value, hdr
+
+def hdr_pkgtup(hdr):
+    '''the (name, arch, epoch, version, release) tuple for hdr, like po.pkgtup'''
+    return (hdr['name'], hdr['arch'], str(hdr['epoch'] or 0),
+            hdr['version'], hdr['release'])
+
+def hdr_keyid(hdr):
+    '''return the (integer) ID of the key that signed hdr, or None'''
+    sigdata = hdr.sigpgp or hdr.siggpg
+    if not sigdata:
+        return None
+    siginfo = yum.pgpmsg.decode(sigdata)[0]
+    (keyid,) = struct.unpack('>Q', siginfo.key_id())
+    return keyid
+
+class ImageSource(namedtuple('ImageSource',
+                               'repoid urls proxy grabfunc grab treeinfo')):
+    '''
+    Everything download_boot_images needs from the instrepo. It gets its
+    own copies of these (made by UpgradeDownloader.image_source) so it can
+    run in a background thread without touching yum's repo objects.
+    '''
+    pass
+
 class UpgradeDownloader(yum.YumBase):
     '''Yum-based downloader class. Based roughly on AnacondaYum.'''
-    def __init__(self, version=None, cachedir=cachedir, cacheonly=False):
+    def __init__(self, version=None, cachedir=cachedir, cacheonly=False,
+                 download_workers=4, mirror_connections=2, cache_quota=None):
         # TODO: special handling for version='test' where we just synthesize
         #       a bunch of fake RPMs with interesting properties
         log.info("UpgradeDownloader(version=%s,cachedir=%s)",version,cachedir)
@@ -105,6 +251,26 @@ class UpgradeDownloader(yum.YumBase):
         self._treeinfo = None
         self.prerepoconf.failure_callback = raise_exception
         self._repoprogressbar = None
+        self.download_workers = download_workers
+        self.mirror_connections = mirror_connections
+        # shared by everything that downloads, so the limit holds even when
+        # packages and boot images are being fetched at the same time
+        self.slots = MirrorSlots(mirror_connections)
+        # boot images bigger than this get fetched in segments from all mirrors
+        self.segment_threshold = 64*1024*1024
+        self.verified = VerifiedIndex(os.path.join(cachedir, 'verified.json'))
+        self.journal = PartialJournal(os.path.join(cachedir, 'partial.json'))
+        self._keytrust = dict() # hexkeyid -> _GPGKeyCheck result
+        self._keytrustcache = None
+        self.depsolved = DepsolveCache(os.path.join(cachedir, 'depsolve.json'))
+        self.problemfile = os.path.join(cachedir, 'problems.json')
+        self.cache_quota = cache_quota
+        self.mirrors = MirrorScoreboard(os.path.join(cachedir, 'mirrors.json'))
+        self.cacheindex = CacheIndex(os.path.join(cachedir, 'cacheindex.json'),
+                                     cachedir, exclude=[bundledir])
+        self._repo_actions = []
+        # headers read while checking signatures, for the transaction test
+        self.pkgheaders = dict() # localPkg() -> hdr
         # TODO: locking to prevent multiple instances
         self.verbose_logger = log
 
@@ -161,6 +327,9 @@ class UpgradeDownloader(yum.YumBase):
             repos.append(('add', '%s=@%s' % (self.instrepoid, mirrorurl)))
             repos.append(('gpgkey', '%s=%s' % (self.instrepoid, defaultkey)))
 
+        # remember these; they affect the depsolve results
+        self._repo_actions = [list(r) for r in repos]
+
         # We need to read .repo files before we can enable/disable them, so:
         self.repos # implicit repo setup! ha ha! what fun!
 
@@ -194,14 +363,21 @@ class UpgradeDownloader(yum.YumBase):
                 repo.gpgkey.append(varReplace(keyurl, self.conf.yumvar))
                 repo.gpgcheck = True
 
-        # check enabled repos
-        for repo in self.repos.listEnabled():
-            try:
-                md_types = repo.repoXML.fileTypes()
-            except yum.Errors.RepoError:
+        # check enabled repos. Each one is (at least) a network round trip,
+        # so check them all at once, but handle the results in order.
+        enabled = self.repos.listEnabled()
+        threadsafe_urlgrabber()
+        probed = dict((repo.id, exc) for (repo, result, exc) in
+                      pmap(self._probe_repo, enabled,
+                           workers=self.download_workers, name='repoprobe'))
+        for repo in enabled:
+            exc = probed[repo.id]
+            if exc and issubclass(exc[0], yum.Errors.RepoError):
                 log.info("can't find valid repo metadata for %s", repo.id)
                 repo.disable()
                 self.disabled_repos.append(repo.id)
+            elif exc:
+                raise exc[0], exc[1], exc[2]
             else:
                 log.info("repo %s seems OK" % repo.id)
 
@@ -211,8 +387,54 @@ class UpgradeDownloader(yum.YumBase):
 
         log.debug("repos.cache=%i", self.repos.cache)
 
+        if not self.cacheonly:
+            self.rank_mirrors()
+
         return self.disabled_repos
 
+    def rank_mirrors(self):
+        '''probe the mirrors of the enabled repos and put the best ones first'''
+        repos = [r for r in self.repos.listEnabled() if len(r.urls) > 1]
+        # one probe per mirror host is plenty; skip the ones cooling down
+        probe = dict()
+        for url in (u for r in repos for u in r.urls if is_network_url(u)):
+            if not self.mirrors.tripped(url):
+                probe.setdefault(mirror_host(url), url)
+        if probe:
+            log.info("probing %u mirrors", len(probe))
+            probe_mirrors(self.mirrors, probe.values(), proxy=self.conf.proxy,
+                          workers=self.download_workers*self.mirror_connections)
+        for repo in repos:
+            ranked = self.mirrors.rank(repo.urls)
+            if ranked != list(repo.urls):
+                log.info("reordered mirrors for %s; using %s first",
+                         repo.id, ranked[0])
+                repo._urls = ranked
+                # 'roundrobin' would just pick one at random
+                repo.failovermethod = 'priority'
+                repo._setupGrab()
+        self.mirrors.save()
+
+    def _probe_repo(self, repo):
+        '''fetch repomd.xml for repo, and its primary metadata while we're
+        at it. Raises RepoError if the repo metadata is no good.'''
+        # progress meters from several threads would just make a mess
+        callback, repo.callback = repo.callback, None
+        try:
+            md_types = repo.repoXML.fileTypes()
+            if self.cacheonly:
+                return md_types
+            metrics.untracked('repo metadata')
+            # yum will want this soon; it'll skip it later if it's here now
+            mdtype = 'primary_db' if 'primary_db' in md_types else 'primary'
+            try:
+                repo.retrieveMD(mdtype)
+            except yum.Errors.RepoError as e:
+                log.info("couldn't prefetch %s for %s: %s", mdtype, repo.id, e)
+            return md_types
+        finally:
+            repo.callback = callback
+
     def save_repo_configs(self):
         '''save repo configuration files for later use'''
         repodir = os.path.join('/etc/yum.repos.d')
@@ -241,78 +463,288 @@ class UpgradeDownloader(yum.YumBase):
     # NOTE: could raise RepoError if metadata is missing/busted
     def build_update_transaction(self, callback=None):
         log.info("looking for updates")
-        self.dsCallback = callback
-        self.update()
-        (rv, msgs) = self.buildTransaction(unfinished_transactions_check=False)
-        # NOTE: self.po_with_problems is now a list of (po1, po2, errmsg) tuples
-        log.info("buildTransaction returned %i", rv)
-        for m in msgs:
-            log.info("    %s", m)
-        # NOTE: we ignore errors, as anaconda did before us.
-        self.dsCallback = None
+        key = self._depsolve_key()
+        saved = self.depsolved.get(key)
+        if saved and self._replay_depsolve(saved):
+            log.info("nothing has changed; reusing previous depsolve results")
+        else:
+            self.dsCallback = callback
+            self.update()
+            (rv, msgs) = self.buildTransaction(unfinished_transactions_check=False)
+            # NOTE: self.po_with_problems is now a list of (po1, po2, errmsg) tuples
+            log.info("buildTransaction returned %i", rv)
+            for m in msgs:
+                log.info("    %s", m)
+            # NOTE: we ignore errors, as anaconda did before us.
+            self.dsCallback = None
+            if key is not None:
+                self.depsolved.set(key, self._dump_depsolve())
+                self.depsolved.save()
         return [t.po for t in self.tsInfo.getMembers()
                      if t.ts_state in ("i", "u")]
 
+    def _depsolve_key(self):
+        '''everything that can change the result of the depsolve, or None
+        if we can't tell.'''
+        cookie = rpmdb_cookie(self.conf.installroot)
+        if cookie is None:
+            return None
+        repos = []
+        for repo in sorted(self.repos.listEnabled(), key=lambda r: r.id):
+            try:
+                digest = hexdigest(os.path.join(repo.cachedir, 'repomd.xml'),
+                                   'sha256')
+            except IOError:
+                return None
+            repos.append([repo.id, repo.repoXML.revision, digest])
+        plugins = sorted(getattr(self.plugins, '_plugins', {}).keys())
+        return {'rpmdb': cookie, 'version': self.version, 'repos': repos,
+                'plugins': plugins, 'actions': self._repo_actions}
+
+    def _dump_depsolve(self):
+        '''tsInfo and po_with_problems, in a form DepsolveCache can save'''
+        def ref(po):
+            return [po.pkgtup, po.repoid] if po else [None, None]
+        members = []
+        for t in self.tsInfo.getMembers():
+            related = [ref(po) + [rel] for po, rel in t.relatedto]
+            members.append(ref(t.po) + [t.output_state, t.ts_state,
+                           t.current_state, t.isDep, t.reason, related])
+        problems = [ref(po1) + ref(po2) + [err]
+                    for po1, po2, err in getattr(self, 'po_with_problems', [])]
+        return {'members': members, 'problems': problems}
+
+    def _replay_depsolve(self, saved):
+        '''
+        Rebuild tsInfo and po_with_problems from a saved depsolve result.
+        If any of the packages can't be found, nothing is changed and
+        False is returned.
+        '''
+        relattr = {'updates': 'updates', 'updatedby': 'updated_by',
+                   'obsoletes': 'obsoletes', 'obsoletedby': 'obsoleted_by',
+                   'dependson': 'depends_on', 'downgrades': 'downgrades',
+                   'downgradedby': 'downgraded_by'}
+        def lookup(pkgtup, repoid):
+            if pkgtup is None:
+                return None
+            if repoid == 'installed':
+                found = self.rpmdb.searchPkgTuple(tuple(pkgtup))
+            else:
+                found = [po for po in self.pkgSack.searchPkgTuple(tuple(pkgtup))
+                            if po.repoid == repoid]
+            if not found:
+                raise KeyError("%s from %s" % ('-'.join(pkgtup), repoid))
+            return found[0]
+        try:
+            txmbrs = []
+            for (pkgtup, repoid, output_state, ts_state, current_state,
+                 isdep, reason, related) in saved['members']:
+                txmbr = TransactionMember(lookup(pkgtup, repoid))
+                txmbr.output_state = txmbr.po.state = output_state
+                txmbr.ts_state = ts_state
+                txmbr.current_state = current_state
+                txmbr.isDep = isdep
+                txmbr.reason = reason
+                for otuple, orepoid, rel in related:
+                    po = lookup(otuple, orepoid)
+                    txmbr.relatedto.append((po, rel))
+                    if rel in relattr:
+                        getattr(txmbr, relattr[rel]).append(po)
+                txmbrs.append(txmbr)
+            problems = set((lookup(t1, r1), lookup(t2, r2), err)
+                           for t1, r1, t2, r2, err in saved['problems'])
+        except (KeyError, ValueError, TypeError, AttributeError) as e:
+            log.info("can't reuse previous depsolve results: %s", e)
+            return False
+        for txmbr in txmbrs:
+            self.tsInfo.add(txmbr)
+        self.tsInfo.changed = False
+        self.po_with_problems = problems
+        return True
+
     def find_packages_without_updates(self):
-        '''packages on the local system that aren't being updated/obsoleted'''
-        remove = self.tsInfo.getMembersWithState(output_states=TS_REMOVE_STATES)
-        return set(p for p in self.rpmdb if p not in remove)
+        '''pkgtups of the packages on the local system that aren't being
+        updated/obsoleted'''
+        remove = set(t.pkgtup for t in
+                 self.tsInfo.getMembersWithState(output_states=TS_REMOVE_STATES))
+        return set(self.rpmdb.simplePkgList()).difference(remove)
 
-    def describe_transaction_problems(self):
-        problems = []
+    def transaction_problems(self):
+        '''
+        Return a list of dicts describing the problems found by the depsolve:
+
+          {'package':  {'old': nevra or None, 'new': nevra or None},
+           'requires': {'old': nevra or None, 'new': nevra or None},
+           'error': errmsg}
+
+        where 'old' is the installed package and 'new' is the one replacing
+        it, if any.
+        '''
+        # index the replacements in one pass over the transaction.
+        # XXX multiple replacers? first one wins, like it always has.
+        replacement = dict()
+        for tx in self.tsInfo.getMembers():
+            if tx.po.pkgtup in replacement:
+                continue
+            for otherpo, rel in tx.relatedto:
+                if rel in ('obsoletedby', 'updatedby'):
+                    replacement[tx.po.pkgtup] = (tx.po, otherpo)
+                    break
+                if rel in ('obsoletes', 'updates'):
+                    replacement[tx.po.pkgtup] = (otherpo, tx.po)
+                    break
+        installed = set(self.rpmdb.simplePkgList())
 
         def find_replacement(po):
-            for tx in self.tsInfo.getMembers(po.pkgtup):
-                # XXX multiple replacers?
-                for otherpo, rel in tx.relatedto:
-                    if rel in ('obsoletedby', 'updatedby'):
-                        return po, otherpo
-                    if rel in ('obsoletes', 'updates'):
-                        return otherpo, po
-            if po in self.rpmdb:
-                return po, None
+            if po.pkgtup in replacement:
+                oldpkg, newpkg = replacement[po.pkgtup]
+            elif po.pkgtup in installed:
+                oldpkg, newpkg = po, None
             else:
-                return None, po
-
-        def format_replacement(po):
-            oldpkg, newpkg = find_replacement(po)
-            if oldpkg and newpkg:
-                return "%s (replaced by %s)" % (oldpkg, newpkg)
-            elif oldpkg:
-                return "%s (no replacement)" % oldpkg
-            elif newpkg:
-                return "%s (new package)" % newpkg
+                oldpkg, newpkg = None, po
+            return {'old': str(oldpkg) if oldpkg else None,
+                    'new': str(newpkg) if newpkg else None}
 
+        problems = []
         done = set()
-        for pkg1, pkg2, err in self.po_with_problems:
+        for pkg1, pkg2, err in getattr(self, 'po_with_problems', []):
             if (pkg1,pkg2) not in done:
-                problems.append("%s requires %s" % (format_replacement(pkg1),
-                                                    format_replacement(pkg2)))
+                problems.append({'package': find_replacement(pkg1),
+                                 'requires': find_replacement(pkg2),
+                                 'error': err})
                 done.add((pkg1,pkg2))
-
         return problems
 
+    def describe_transaction_problems(self):
+        def format_replacement(r):
+            if r['old'] and r['new']:
+                return "%s (replaced by %s)" % (r['old'], r['new'])
+            elif r['old']:
+                return "%s (no replacement)" % r['old']
+            elif r['new']:
+                return "%s (new package)" % r['new']
+
+        report = self.transaction_problems()
+        self.save_problem_report(report)
+        return ["%s requires %s" % (format_replacement(p['package']),
+                                    format_replacement(p['requires']))
+                for p in report]
+
+    def save_problem_report(self, report):
+        '''save the problem report as JSON, for other tools to look at'''
+        out = JSONCache(self.problemfile)
+        out.data = {'version': self.version, 'problems': report}
+        out.dirty = True
+        out.save()
+
+    def plan_disk_space(self, pkgs, bootimages=True, export=False):
+        '''
+        Estimate how much space the upgrade will need on each filesystem,
+        using the sizes in the repo metadata - before anything gets
+        downloaded. Returns a list of (mountpoint, needed, available) for
+        the filesystems that don't have enough room.
+        If export is True, the boot images only go into cachedir (see
+        download_boot_images).
+        '''
+        plan = DiskPlan()
+        # packages get hardlinked into packagedir if they can be
+        copies = plan.mountpoint(cachedir+'/') != plan.mountpoint(packagedir+'/')
+        for po in pkgs:
+            if not is_remote(po):
+                continue
+            local = po.localPkg()
+            have = os.path.getsize(local) if os.path.exists(local) else 0
+            plan.add(local, max(0, po.size - have))
+            if copies:
+                plan.add(packagedir+'/', po.size)
+        if bootimages:
+            cacheinitrd = os.path.join(cachedir, os.path.basename(initrdpath))
+            if export:
+                images = (('kernel', [os.path.join(cachedir,
+                                          os.path.basename(kernelpath))]),
+                          ('upgrade', [cacheinitrd]))
+            else:
+                images = (('kernel', [kernelpath]),
+                          ('upgrade', [cacheinitrd, initrdpath]))
+            arch = self.treeinfo.get('general', 'arch')
+            for imgtype, paths in images:
+                paths = [p for p in paths if not os.path.exists(p)]
+                if not paths:
+                    continue
+                size = self._boot_image_size(self.treeinfo.get_image(arch, imgtype))
+                for path in paths:
+                    plan.add(path, size)
+        plan_install(self.tsInfo, plan)
+        return plan.shortfalls()
+
+    def _boot_image_size(self, relpath):
+        '''how big the image at relpath is, or 0 if we can't tell.
+        .treeinfo doesn't list sizes, so this asks the first mirror, but
+        it's only an estimate, so it doesn't wait long for an answer.'''
+        for url in self.instrepo.urls:
+            fullurl = url.rstrip('/') + '/' + relpath
+            if url.startswith('file://'):
+                try:
+                    return os.path.getsize(fullurl[7:])
+                except OSError:
+                    continue
+            size, ranges = remote_size(fullurl, proxy=self.instrepo.proxy,
+                                       timeout=5)
+            if size:
+                return size
+            break
+        log.info("can't tell how big %s is", relpath)
+        return 0
+
     def download_packages(self, pkgs, callback=None):
+        try:
+            self._download_packages(pkgs, callback)
+        finally:
+            # save what we verified, even if we got interrupted
+            self.verified.save()
+            self.cacheindex.save()
+            self.mirrors.save()
+            self.journal.save()
+
+    def _download_packages(self, pkgs, callback=None):
         # Verifying a full upgrade payload of ~2000 pkgs takes a good 90-120
         # seconds with no callback. Unacceptable!
-        # So: here we have our own verifyPkg loop, with callback.
+        # So: here we have our own verify loop, with callback, that checksums
+        # the packages in a pool of worker processes.
         # The results get cached, so when yum does it again in the real
         # _downloadPackages function it's a negligible delay.
         localpkgs = [p for p in pkgs if os.path.exists(p.localPkg())]
-        total = len(localpkgs)
-        # XXX: multithreading?
-        for num, p in enumerate(localpkgs, 1):
-            local = p.localPkg()
-            if hasattr(callback, "verify") and callable(callback.verify):
-                callback.verify(num, total, local, None)
-            ok = self.verifyPkg(local, p, False) # result will be cached by yum
+        verified = self._verify_local_packages(localpkgs, callback)
+
+        # Fetch everything that's missing with our concurrent downloader,
+        # checking signatures as each package arrives (and checking the ones
+        # we already had while that's going on).
+        # Anything it couldn't get is left for yum, which will retry it and
+        # report errors the usual way.
+        sigchecked = set()
+        if self.download_workers > 1:
+            fetch = []
+            if not self.cacheonly:
+                fetch = [p for p in pkgs if p not in verified and is_remote(p)]
+            sigchecked = self._fetch_packages(fetch, verified, callback)
+
         log.info("beginning package download...")
-        updates = self._downloadPackages(callback)
+        if any(is_remote(p) and not os.path.exists(p.localPkg()) for p in pkgs):
+            metrics.untracked('yum package downloads')
+        try:
+            updates = self._downloadPackages(callback)
+        finally:
+            # remember what yum got, even if some of it failed
+            for p in pkgs:
+                self._record_verified(p)
 
         # Handle _downloadPackages returning None instead of an empty list
         if updates is None:
             updates = []
 
+        for p in set(updates).difference(pkgs):
+            self._record_verified(p)
+
         if set(updates) != set(pkgs):
             log.debug("differences between requested pkg set and downloaded:")
             for p in set(pkgs).difference(updates):
@@ -320,20 +752,152 @@ class UpgradeDownloader(yum.YumBase):
             for p in set(updates).difference(pkgs):
                 log.debug("  +%s", p)
         # check signatures of downloaded packages
+        updates = [p for p in updates if p not in sigchecked]
         if updates:
             self._checkSignatures(updates, callback)
 
+    def _record_verified(self, po):
+        '''add po to the verified-file index, if yum has verified it'''
+        st = getattr(po, '_verify_local_pkg_cache', None)
+        if st:
+            self.verified.record(po.localPkg(), po.returnIdSum()[0],
+                                 po.returnIdSum()[1], st)
+            self.cacheindex.add(po.localPkg(), st.st_size)
+
+    def _verify_local_packages(self, localpkgs, callback=None):
+        '''Checksum the given local packages, using all the CPUs we've got.
+        Returns the set of packages that were OK.'''
+        verified = set()
+        # files that haven't changed since a previous run don't need hashing
+        for p in localpkgs:
+            (algo, digest) = p.returnIdSum()
+            st = self.verified.check(p.localPkg(), algo, digest)
+            if st:
+                p._verify_local_pkg_cache = st
+                verified.add(p)
+        if verified:
+            log.info("%u local packages already verified", len(verified))
+            localpkgs = [p for p in localpkgs if p not in verified]
+
+        total = len(localpkgs)
+        if total < 2*cpu_count(): # not worth starting up the pool
+            for num, p in enumerate(localpkgs, 1):
+                local = p.localPkg()
+                if hasattr(callback, "verify") and callable(callback.verify):
+                    callback.verify(num, total, local, None)
+                if self.verifyPkg(local, p, False): # result cached by yum
+                    verified.add(p)
+                    self._record_verified(p)
+            return verified
+
+        bypath = dict((p.localPkg(), p) for p in localpkgs)
+        jobs = [(path, po.returnIdSum()[0], po.size)
+                for (path, po) in bypath.items()]
+        log.info("verifying %u local packages with %u processes",
+                 total, cpu_count())
+        results = process_map(checksum_file, jobs)
+        for num, (local, st, digest) in enumerate(results, 1):
+            p = bypath[local]
+            if hasattr(callback, "verify") and callable(callback.verify):
+                callback.verify(num, total, local, None)
+            if digest is not None and digest == p.returnIdSum()[1]:
+                # this is how YumAvailablePackage.verifyLocalPkg() remembers
+                # that it already checked the file
+                p._verify_local_pkg_cache = st
+                verified.add(p)
+                self._record_verified(p)
+            else:
+                log.debug("%s failed verification", local)
+        return verified
+
+    def _fetch_packages(self, pkgs, localpkgs=[], callback=None):
+        '''Download pkgs and check the signatures of everything in pkgs and
+        localpkgs. Returns the set of packages with good signatures.'''
+        for p in pkgs:
+            local = p.localPkg()
+            (algo, digest) = p.returnIdSum()
+            # resume partial files we know about, remove everything else
+            if self.journal.start(local, p.relativepath, algo, digest) and \
+                    os.path.exists(local) and os.path.getsize(local) >= p.size:
+                log.debug("removing bad package file %s", local)
+                os.remove(local)
+        self.journal.save()
+        checkfunc = lambda po: (self._verify_download, (po,), {})
+        fetcher = PackageFetcher(workers=self.download_workers,
+                                 mirror_connections=self.mirror_connections,
+                                 checkfunc=checkfunc, scoreboard=self.mirrors,
+                                 slots=self.slots)
+        pipeline = DownloadPipeline(fetcher, self._check_package)
+        def done(po):
+            self.journal.finish(po.localPkg())
+            self._record_verified(po)
+        checked, failed = pipeline.run(pkgs, localpkgs, callback, done=done)
+        if failed:
+            log.info("%u packages failed to download; leaving them for yum",
+                     len(failed))
+        return set(checked)
+
+    def _verify_download(self, fo, po):
+        '''
+        urlgrabber checkfunc for PackageFetcher. This runs in the download
+        threads, so unlike YumBase.verifyPkg it only checks the file's
+        checksum - reading the header with yum's shared rpmdb transaction
+        set isn't safe here. _check_package checks the header afterward.
+        '''
+        if not po.verifyLocalPkg():
+            raise URLGrabError(-1,
+                    _('Package does not match intended download.'))
+        return True
+
+    def _check_package(self, po):
+        '''
+        DownloadPipeline check function: make sure the header matches po
+        and check the package signature. Returns True if it's OK, False if
+        the file is damaged, and None if it needs a key imported (or
+        anything else that _checkSignatures has to deal with).
+        '''
+        sigcheck = po.repo.gpgcheck and not self._override_sigchecks
+        value, hdr = checksig(po.localPkg(), sigcheck)
+        if hdr is not None and hdr_pkgtup(hdr) != po.pkgtup:
+            log.info("%s doesn't match the repo metadata for %s",
+                     po.localPkg(), po)
+            return False
+        if value == 0:
+            self.pkgheaders[po.localPkg()] = hdr
+            return True
+        elif value == 2:
+            return False
+        return None
+
     def clean_cache(self, keepfiles):
+        '''
+        Remove unneeded rpms from the cache. Files in keepfiles (the packages
+        we're about to use) are always kept.
+
+        If there's no cache_quota, every other rpm in the enabled repos is
+        removed. Otherwise the least recently used rpms (from any repo) are
+        removed until the cache fits in cache_quota bytes.
+        '''
         log.info("checking for unneeded rpms in cache")
-        # Find all the packages in the caches (not on media though)
-        localpkgs = set(f for r in self.repos.listEnabled() if not r.mediaid
-                          for f in listdir(r.pkgdir) if f.endswith(".rpm"))
-        for f in localpkgs.difference(keepfiles):
-            try:
-                log.debug("removing %s", f)
-                os.remove(f)
-            except IOError as e:
-                log.info("failed to remove %s", f)
+        keepfiles = set(keepfiles)
+        for f in keepfiles:
+            self.cacheindex.touch(f)
+        if self.cache_quota is None:
+            # Find all the packages in the caches (not on media though)
+            pkgdirs = tuple(r.pkgdir.rstrip('/') + '/'
+                            for r in self.repos.listEnabled() if not r.mediaid)
+            unneeded = [f for f in self.cacheindex.files
+                          if f.startswith(pkgdirs) and f not in keepfiles]
+            removed = [f for f in unneeded if self.cacheindex.remove(f)]
+        else:
+            log.info("cache is using %u bytes (quota %u)",
+                     self.cacheindex.total, self.cache_quota)
+            removed = self.cacheindex.trim(self.cache_quota, keepfiles)
+        for f in removed:
+            self.verified.forget(f)
+        log.info("removed %u unneeded rpms", len(removed))
+        self.cacheindex.save()
+        self.verified.save()
         # TODO remove dirs that don't belong to any repo
 
     def _get_treeinfo(self):
@@ -343,6 +907,7 @@ class UpgradeDownloader(yum.YumBase):
         if self.cacheonly:
             log.debug("using cached .treeinfo %s", outfile)
             return outfile
+        metrics.untracked('.treeinfo')
 
         if self.instrepo.gpgcheck and not self._override_sigchecks:
             log.debug("fetching .treeinfo.signed from '%s'", self.instrepoid)
@@ -376,40 +941,161 @@ class UpgradeDownloader(yum.YumBase):
     def treeinfo(self):
         if self._treeinfo is None:
             self._treeinfo = Treeinfo(self._get_treeinfo())
+            self._treeinfo.verified = self.verified
             log.debug("validating .treeinfo")
             self._treeinfo.checkvalues()
         return self._treeinfo
 
-    def download_boot_images(self, arch=None):
+    def image_source(self):
+        '''
+        Make an ImageSource for the instrepo, with its own URLGrabber and
+        MirrorGroup (using the repo's mirror order) and its own Treeinfo.
+        Call this from the main thread.
+        '''
+        repo = self.instrepo
+        urls = list(repo.urls)
+        grabfunc = URLGrabber(reget='simple', **repo._default_grabopts())
+        if repo.failovermethod == 'roundrobin':
+            grab = MGRandomOrder(grabfunc, urls)
+        else:
+            grab = MirrorGroup(grabfunc, urls)
+        buf = StringIO()
+        self.treeinfo.write(buf)
+        buf.seek(0)
+        treeinfo = Treeinfo(buf, topdir=self.treeinfo.topdir)
+        treeinfo.verified = self.verified
+        return ImageSource(self.instrepoid, urls, repo.proxy, grabfunc, grab,
+                           treeinfo)
+
+    def download_boot_images(self, arch=None, background=False, export=False,
+                             source=None, cancel=None):
+        '''Fetch the kernel and upgrade initrd. If background is True,
+        something else is using the console, so don't show progress.
+        If export is True, they're only wanted for export_bundle, so they
+        stay in cachedir and /boot and upgrade.conf are left alone.
+
+        To run this in a background thread, pass an ImageSource made by
+        image_source() on the main thread; if cancel (a threading.Event)
+        gets set, it gives up and raises fetch.Cancelled.'''
+        if source is None:
+            source = self.image_source()
+        treeinfo = source.treeinfo
+        # kernel and initrd are fetched at the same time, so don't let them
+        # both draw progress bars at once
+        concurrent = self.download_workers > 1
+        quiet = concurrent or background
+        grabopts = dict(progress_obj=None) if quiet else dict()
+        # helper function to fetch big images from all the mirrors at once.
+        # returns the digest of the data, or None if it didn't work out.
+        def grab_segmented(relpath, partial, resume, algo):
+            urls = [u for u in source.urls
+                      if u.startswith(('http:', 'https:'))]
+            if not urls or not concurrent:
+                return None
+            size, ranges = remote_size(urls[0].rstrip('/') + '/' + relpath,
+                                       proxy=source.proxy)
+            if not (size and ranges) or size < self.segment_threshold:
+                return None
+            hasher = hashlib.new(algo)
+            try:
+                fetch_segmented(source.grabfunc, urls, relpath,
+                                partial, size,
+                                slots=self.slots,
+                                workers=self.download_workers, resume=resume,
+                                hasher=hasher, repoid=source.repoid,
+                                cancel=cancel)
+                return hasher.hexdigest()
+            except (URLGrabError, IOError, OSError) as e:
+                log.info("segmented download of %s failed: %s", relpath, e)
+            # start over with a single stream
+            rm_f(partial)
+            remove_segments(partial)
+            return None
+
+        # helper function to fetch an image in one stream; returns its digest
+        def grab_stream(relpath, partial, resume, algo):
+            hasher = hashlib.new(algo)
+            have = os.path.getsize(partial) if os.path.exists(partial) else 0
+            start = time.time()
+            try:
+                url = fetch_hashed(source.grab, relpath, partial, hasher,
+                                   resume=resume, cancel=cancel, **grabopts)
+            except URLGrabError:
+                metrics.transfer(source.repoid, None,
+                                 elapsed=time.time()-start, failed=True)
+                raise
+            if url:
+                got = os.path.getsize(partial) - (have if resume else 0)
+                metrics.transfer(source.repoid, url, got, time.time()-start)
+            return hasher.hexdigest()
+
         # helper function to grab and checksum image files listed in .treeinfo
-        def grab_and_check(imgarch, imgtype, outpath):
-            relpath = self.treeinfo.get_image(imgarch, imgtype)
+        def grab_and_check(job):
+            imgarch, imgtype, outpath = job
+            relpath = treeinfo.get_image(imgarch, imgtype)
             log.debug("grabbing %s %s", imgarch, imgtype)
             log.info("downloading %s to %s", relpath, outpath)
-            if self.treeinfo.checkfile(outpath, relpath):
+            if treeinfo.checkfile(outpath, relpath):
                 log.debug("file already exists and checksum OK")
                 return outpath
-            def checkfile(cb):
-                log.debug("checking %s", relpath)
-                if not self.treeinfo.checkfile(cb.filename, relpath):
-                    log.info("checksum doesn't match - retrying")
-                    raise yum.URLGrabError(-1)
-            return self.instrepo.grab.urlgrab(relpath, outpath,
-                                              checkfunc=checkfile,
-                                              reget=None,
-                                              copy_local=True)
+            # download to a partial file, which we can resume if interrupted.
+            # the data gets checksummed on its way to the disk.
+            partial = outpath + '.part'
+            algo, digest = treeinfo.get_checksum(relpath)
+            resume = self.journal.start(partial, relpath, algo, digest)
+            self.journal.save()
+            got = grab_segmented(relpath, partial, resume, algo)
+            if got != digest:
+                if got:
+                    remove_segments(partial)
+                    resume = False
+                got = grab_stream(relpath, partial, resume, algo)
+            if got != digest and resume:
+                log.info("checksum doesn't match - retrying")
+                got = grab_stream(relpath, partial, False, algo)
+            if got != digest:
+                rm_f(partial) # don't resume from a bad file
+                raise yum.URLGrabError(-1, _("checksum doesn't match for %s")
+                                           % relpath)
+            os.rename(partial, outpath)
+            self.journal.finish(partial)
+            self.verified.forget(partial)
+            self.verified.record(outpath, algo, digest)
+            return outpath
 
         # download the images
         try:
             if not arch:
-                arch = self.treeinfo.get('general', 'arch')
-            kernel = grab_and_check(arch, 'kernel', kernelpath)
+                arch = treeinfo.get('general', 'arch')
             # cache the initrd somewhere so we don't have to fetch it again
             # if it gets modified later.
             cacheinitrd = os.path.join(cachedir, os.path.basename(initrdpath))
-            initrd = grab_and_check(arch, 'upgrade', cacheinitrd)
+            if export:
+                kernelout = os.path.join(cachedir, os.path.basename(kernelpath))
+            else:
+                kernelout = kernelpath
+                # Save kernel/initrd info before writing anything to /boot,
+                # so --clean can find them (or what's left of them) even if
+                # we don't get to finish
+                with Config(upgradeconf) as conf:
+                    conf.set("boot", "kernel", kernelpath)
+                    conf.set("boot", "initrd", initrdpath)
+            jobs = [(arch, 'kernel', kernelout),
+                    (arch, 'upgrade', cacheinitrd)]
+            if quiet:
+                threadsafe_urlgrabber()
+            images = dict()
+            for job, outpath, exc in pmap(grab_and_check, jobs,
+                                          len(jobs) if concurrent else 1,
+                                          name='bootimg'):
+                if exc:
+                    raise exc[0], exc[1], exc[2]
+                images[job[1]] = outpath
+            kernel = images['kernel']
+            if export:
+                return kernel, images['upgrade']
             # copy the downloaded initrd to the target path
-            copy2(initrd, initrdpath)
+            copy2(images['upgrade'], initrdpath)
             initrd = initrdpath
         except TreeinfoError as e:
             raise YumBaseError(_("invalid data in .treeinfo: %s") % str(e))
@@ -429,30 +1115,137 @@ class UpgradeDownloader(yum.YumBase):
             else:
                 # The exception actually was a KeyBoardInterrupt, re-raise it
                 raise
-
-        # Save kernel/initrd info so we can clean it up later
-        with Config(upgradeconf) as conf:
-            conf.set("boot", "kernel", kernel)
-            conf.set("boot", "initrd", initrd)
+        except Cancelled:
+            log.info("boot image download cancelled")
+            raise
+        finally:
+            self.verified.save()
+            self.journal.save()
 
         return kernel, initrd
 
+    def export_bundle(self, filename, pkgs, images=None):
+        '''
+        Write a bundle (see bundle.py) with everything needed to do this
+        upgrade without the network: the metadata for the enabled repos, the
+        packages in pkgs, and (if images is the (kernel, initrd) result of
+        download_boot_images(export=True)) .treeinfo and the boot images.
+        Raises BundleError if a repo with gpgcheck enabled has no keys, or
+        if some of a repo's metadata can't be fetched.
+        '''
+        arch = self.treeinfo.get('general', 'arch')
+        byrepo = dict()
+        for po in pkgs:
+            byrepo.setdefault(po.repoid, []).append(po)
+        with BundleWriter(filename, self.version, arch) as bundle:
+            for repo in self.repos.listEnabled():
+                log.info("adding repo %s to bundle", repo.id)
+                ent = bundle.add_repo(repo.id, bool(repo.gpgcheck))
+                for keyurl in repo.gpgkey:
+                    bundle.add_key(ent, keyurl)
+                top = 'repos/%s/' % repo.id
+                bundle.add_file(os.path.join(repo.cachedir, 'repomd.xml'),
+                                top + 'repodata/repomd.xml')
+                # repomd.xml lists all of these, so they all have to be
+                # there, even the ones we didn't need to download
+                for mdtype in repo.repoXML.fileTypes():
+                    location = repo.repoXML.getData(mdtype).location[1]
+                    local = os.path.join(repo.cachedir,
+                                         os.path.basename(location))
+                    if not os.path.exists(local):
+                        try:
+                            local = repo.retrieveMD(mdtype)
+                        except yum.Errors.RepoError as e:
+                            raise BundleError(_("can't get %s metadata for "
+                                                "%s: %s") % (mdtype, repo.id, e))
+                    bundle.add_file(local, top + location)
+                for po in byrepo.get(repo.id, []):
+                    if os.path.exists(po.localPkg()):
+                        bundle.add_file(po.localPkg(), top + po.relativepath)
+                    else:
+                        log.warn("%s missing; not adding it to bundle", po)
+            if images:
+                top = 'repos/%s/' % self.instrepoid
+                bundle.manifest['instrepo'] = self.instrepoid
+                for name in ('.treeinfo', '.treeinfo.signed'):
+                    path = os.path.join(cachedir, name)
+                    if os.path.exists(path):
+                        bundle.add_file(path, top + name)
+                for imgtype, path in zip(('kernel', 'upgrade'), images):
+                    relpath = self.treeinfo.get_image(arch, imgtype)
+                    bundle.add_file(path, top + relpath)
+                    bundle.manifest['images'][imgtype] = relpath
+
     def _checkSignatures(self, pkgs, callback):
         '''check the package signatures and get keys if needed.
            works like YumBase._checkSignatures() except it only uses our
-           special automatic _GPGKeyCheck to import untrusted keys.'''
-        for po in pkgs:
+           special automatic _GPGKeyCheck to import untrusted keys.
+
+           Signatures get checked in a pool of threads. Only the first package
+           signed with each unknown key goes through getKeyForPackage; once
+           that key is imported, the rest of its packages get re-checked.'''
+        pending = self._sigcheck_pass(pkgs)
+        imported = set() # keyids we've imported keys for
+        keyfetched = set() # packages we've called getKeyForPackage for
+        while pending:
+            po, keyid = pending.pop(0)
             result, errmsg = self.sigCheckPkg(po)
             if result == 0:
                 continue
-            elif result == 1:
+            elif result == 1 and po not in keyfetched and \
+                    (keyid is None or keyid not in imported):
                 keycheck = lambda info: self._GPGKeyCheck(info, callback)
+                metrics.untracked('gpg keys')
                 self.getKeyForPackage(po, fullaskcb=keycheck)
+                keyfetched.add(po)
+                # check it again, along with everything else signed with
+                # that key (if we know which key that was)
+                samekey = [po]
+                if keyid is not None:
+                    imported.add(keyid)
+                    samekey += [p for (p, k) in pending if k == keyid]
+                    pending = [(p, k) for (p, k) in pending if k != keyid]
+                pending = self._sigcheck_pass(samekey) + pending
             else:
                 raise yum.Errors.YumGPGCheckError(errmsg)
 
+    def _sigcheck_job(self, po):
+        if self._override_sigchecks or not po.repo.gpgcheck:
+            return True, None
+        value, hdr = checksig(po.localPkg())
+        if value == 0:
+            self.pkgheaders[po.localPkg()] = hdr
+        return (value == 0), (hdr_keyid(hdr) if hdr else None)
+
+    def _sigcheck_pass(self, pkgs):
+        '''check signatures of pkgs in parallel. returns a list of
+        (po, keyid) for the packages that didn't pass, in the given order.'''
+        if not pkgs:
+            return []
+        order = dict((po, n) for n, po in enumerate(pkgs))
+        failed = []
+        for po, result, exc in pmap(self._sigcheck_job, pkgs,
+                                    workers=cpu_count(), name='sigcheck'):
+            if exc:
+                log.debug("signature check of %s failed: %s", po, exc[1])
+                failed.append((po, None))
+            elif not result[0]:
+                failed.append((po, result[1]))
+        failed.sort(key=lambda f: order[f[0]])
+        return failed
+
     def _GPGKeyCheck(self, info, callback=None):
         '''special key importer: import trusted keys automatically'''
+        hexkeyid = info.get('hexkeyid')
+        if hexkeyid in self._keytrust:
+            log.debug("already decided about key %s", hexkeyid)
+            return self._keytrust[hexkeyid]
+        trusted = self._check_key_trust(info)
+        if hexkeyid:
+            self._keytrust[hexkeyid] = trusted
+        return trusted
+
+    def _check_key_trust(self, info):
         if info['keyurl'].startswith("file://"):
             keyfile = info['keyurl'][7:]
         else:
@@ -476,69 +1269,148 @@ class UpgradeDownloader(yum.YumBase):
         keys. It'd be a lot more straightforward if we just signed the new
         release key with the old release key - "If you trust this, you can
         trust this too.."
+
+        The decisions are remembered (see cache.KeyTrustCache) until the key
+        file or the rpmdb changes.
         '''
         if keyfile.startswith('file://'):
             keyfile = keyfile[7:]
+        try:
+            digest = hexdigest(keyfile, 'sha256')
+        except IOError:
+            digest = None
+        cached = digest and self.keytrust.get(keyfile, digest)
+        if cached:
+            owner, trusted = cached
+            log.info("keyfile %s (from %s) was already %s", keyfile, owner,
+                     "accepted" if trusted else "rejected")
+            return trusted
+        trusted, owner = self._check_keyfile(keyfile)
+        if digest:
+            self.keytrust.set(keyfile, digest, owner, trusted)
+            self.keytrust.save()
+        return trusted
+
+    @property
+    def keytrust(self):
+        if self._keytrustcache is None:
+            self._keytrustcache = KeyTrustCache(
+                    os.path.join(cachedir, 'keytrust.json'), rpmdb_cookie())
+        return self._keytrustcache
+
+    def _check_keyfile(self, keyfile):
+        '''the actual checks for check_keyfile. returns (trusted, owner),
+        where owner is the NEVRA of the package that owns keyfile.'''
+        owner = None
         # did the key come from a package?
         keypkgs = self.rpmdb.searchFiles(keyfile)
         log.info("checking keyfile %s", keyfile)
         if keypkgs:
             keypkg = sorted(keypkgs)[-1]
+            owner = keypkg.nevra
             log.debug("keyfile owned by package %s", keypkg.nevr)
         if not keypkgs:
             log.info("REJECTED: %s does not belong to any package")
-            return False
+            return False, owner
 
         # was that package signed?
         hdr = keypkg.returnLocalHeader()
-        if hdr.sigpgp or hdr.siggpg:
-            sigdata = hdr.sigpgp or hdr.siggpg
-            siginfo = yum.pgpmsg.decode(sigdata)[0]
-            (keyid,) = struct.unpack('>Q', siginfo.key_id())
+        keyid = hdr_keyid(hdr)
+        if keyid is not None:
             hexkeyid = yum.misc.keyIdToRPMVer(keyid)
             log.debug("package was signed with key %s", hexkeyid)
         else:
             log.info("REJECTED: %s was unsigned", keypkg.nevr)
-            return False
+            return False, owner
 
         # do we trust the key that signed it?
         if yum.misc.keyInstalled(self.ts, keyid, 0) >= 0:
             log.debug("key %s is trusted by rpm", hexkeyid)
         else:
             log.info("REJECTED: key %s is not trusted by rpm", hexkeyid)
-            return False
+            return False, owner
 
         # has the key been tampered with?
         problems = keypkg.verify([keyfile]).get(keyfile, [])
         if problems:
             log.info("REJECTED: keyfile does not match packaged file (%s)",
                      keyfile, " ".join(p.type for p in problems))
-            return False
+            return False, owner
 
         # everything checks out OK!
-        return True
+        return True, owner
 
     def _setup_keyring(self, gpgdir):
-        # set up a fresh gpgdir
-        rm_rf(gpgdir)
+        '''
+        Make the keyring in gpgdir hold the keys trusted by rpm, plus any
+        trustworthy instrepo keys. The keyring is kept between runs, along
+        with an index of the keys in it; keys only get added or removed when
+        the set of trusted keys has changed.
+        '''
         init_keyring(gpgdir)
-
-        # import trusted keys from rpmdb
+        index = JSONCache(os.path.join(gpgdir, 'index.json'))
+        if not os.path.exists(os.path.join(gpgdir, 'pubring.gpg')):
+            index.clear()
+        try:
+            self._update_keyring(gpgdir, index)
+        except gpgme.GpgmeError as e:
+            log.info("updating keyring failed (%s); rebuilding it", e)
+            rm_rf(gpgdir)
+            init_keyring(gpgdir)
+            index = JSONCache(os.path.join(gpgdir, 'index.json'))
+            self._update_keyring(gpgdir, index)
+        index.save()
+
+    def _update_keyring(self, gpgdir, index):
+        # trusted keys from rpmdb, by version-release
         log.debug("checking rpmdb trusted keys")
-        pubring_keys = list_keyring(gpgdir)
-        for hdr in self.ts.dbMatch('name', 'gpg-pubkey'):
-            if hdr.version not in pubring_keys:
-                import_key(hdr.description, hdr.version, gpgdir)
-            else:
-                log.debug("key %s is already in keyring", hdr.version)
+        rpmkeys = dict(('%s-%s' % (hdr.version, hdr.release), hdr)
+                       for hdr in self.ts.dbMatch('name', 'gpg-pubkey'))
+        oldkeys = index.data.get('rpmdb', {})
+        # instrepo keys, with a stamp that tells us if they (or the rpmdb,
+        # which decides whether we trust them) have changed
+        cookie = rpmdb_cookie()
+        instkeys = dict((k, keystamp(k, cookie)) for k in self.instrepo.gpgkey)
+        oldinst = index.data.get('instrepo', {})
+        def unchanged(k):
+            stamp = instkeys[k]
+            return stamp is not None and oldinst.get(k, {}).get('stamp') == stamp
+
+        if set(rpmkeys) == set(oldkeys) and all(map(unchanged, instkeys)) \
+           and set(instkeys) == set(oldinst):
+            log.debug("keyring is up to date")
+            return
+
+        # throw out keys that aren't wanted anymore
+        remove = set(oldkeys[k] for k in oldkeys if k not in rpmkeys)
+        for k, ent in oldinst.items():
+            if k not in instkeys or not unchanged(k):
+                remove.update(ent.get('keys', []))
+        remove.difference_update(hdr.version for hdr in rpmkeys.values())
+        if remove:
+            delete_keys(remove, gpgdir)
+
+        # import new rpmdb keys in one go
+        newkeys = [k for k in rpmkeys if k not in oldkeys]
+        import_keys([rpmkeys[k].description for k in newkeys], gpgdir)
+        index.data['rpmdb'] = dict((k, hdr.version)
+                                   for (k, hdr) in rpmkeys.items())
 
         # check instrepo keys to see if they're trustworthy
         log.info("checking GPG keys for instrepo")
-        for k in self.instrepo.gpgkey:
+        inst = dict()
+        for k, stamp in instkeys.items():
+            if unchanged(k):
+                inst[k] = oldinst[k]
+                continue
+            keyids = []
             if self.check_keyfile(k):
                 keys = self._retrievePublicKey(k) # XXX getSig?
-                for info in keys:
-                    import_key(info['raw_key'], info['hexkeyid'], gpgdir)
+                import_keys([info['raw_key'] for info in keys], gpgdir)
+                keyids = [info['hexkeyid'] for info in keys]
+            inst[k] = dict(stamp=stamp, keys=keyids)
+        index.data['instrepo'] = inst
+        index.dirty = True
 
     def check_signed_file(self, signedfile, outfile, gpgdir=cachedir+'/gpgdir'):
         '''
@@ -0,0 +1,403 @@
+# fetch.py - concurrent package downloads
+#
+# Copyright (C) 2026 The redhat-upgrade-tool contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import glob
+import urllib2
+import threading
+from Queue import Queue
+from shutil import copyfileobj
+from multiprocessing import cpu_count
+from urlgrabber.grabber import URLGrabError
+
+from .parallel import WorkerPool, pmap, qget, threadsafe_urlgrabber
+from .metrics import metrics
+from .mirrors import mirror_host
+from .util import mkdir_p, rm_f
+
+import logging
+log = logging.getLogger(__package__+".fetch")
+
+class Cancelled(Exception):
+    '''Raised by the fetch functions when their cancel event gets set.'''
+    pass
+
+def check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
+
+class MirrorSlots(object):
+    '''Limit the number of simultaneous connections to each mirror host
+    (one host often serves lots of repos).'''
+    def __init__(self, limit=2):
+        self.limit = max(1, limit)
+        self._cond = threading.Condition()
+        self._busy = dict()
+
+    def acquire(self, urls, tripped=None):
+        '''Return the first url in urls whose host has a free slot, waiting
+        for one to open up if they're all busy.
+        If tripped is given, urls for which tripped(url) is True are only
+        used if there's nothing else left in urls.'''
+        if tripped:
+            urls = [u for u in urls if not tripped(u)] or urls
+        with self._cond:
+            while True:
+                for url in urls:
+                    host = mirror_host(url)
+                    if self._busy.get(host, 0) < self.limit:
+                        self._busy[host] = self._busy.get(host, 0) + 1
+                        return url
+                self._cond.wait(0.5)
+
+    def release(self, url):
+        with self._cond:
+            self._busy[mirror_host(url)] -= 1
+            self._cond.notify_all()
+
+def package_urls(po):
+    '''Return the list of base urls that po can be fetched from.'''
+    if getattr(po, 'basepath', None):
+        return [po.basepath]
+    return list(po.repo.urls)
+
+def is_remote(po):
+    '''True if po has to be fetched over the network.'''
+    urls = package_urls(po)
+    return bool(urls) and not po.repo.mediaid and \
+           not all(u.startswith('file:') for u in urls)
+
+class PackageFetcher(object):
+    '''
+    Download packages using a pool of worker threads.
+
+    Each worker picks the first mirror (in the repo's mirror order) that has
+    a free connection slot, and moves on to the next mirror if that fails.
+    checkfunc should be a urlgrabber-style (func, args, kwargs) checkfunc
+    factory: checkfunc(po) -> (func, args, kwargs).
+
+    slots can be a MirrorSlots shared with other downloaders; otherwise
+    one is made with the given mirror_connections limit.
+
+    If scoreboard (a mirrors.MirrorScoreboard) is given, every download
+    gets recorded there and the mirrors are tried in the order it ranks them.
+    '''
+    def __init__(self, workers=4, mirror_connections=2, checkfunc=None,
+                 scoreboard=None, slots=None):
+        self.workers = workers
+        self.slots = slots or MirrorSlots(mirror_connections)
+        self.checkfunc = checkfunc
+        self.scoreboard = scoreboard
+        threadsafe_urlgrabber()
+
+    def _grab(self, po, baseurl, local):
+        url = baseurl.rstrip('/') + '/' + po.relativepath.lstrip('/')
+        kwargs = dict(progress_obj=None, text=None, reget='simple',
+                      size=po.size)
+        if self.checkfunc:
+            kwargs['checkfunc'] = self.checkfunc(po)
+        log.debug("fetching %s", url)
+        return po.repo.grabfunc.urlgrab(url, local, **kwargs)
+
+    def fetch(self, po):
+        '''Download a single package, trying each mirror in turn.
+        Returns the base url it came from; raises the last URLGrabError if
+        every mirror failed.'''
+        local = po.localPkg()
+        mkdir_p(os.path.dirname(local))
+        urls = package_urls(po)
+        if self.scoreboard:
+            urls = self.scoreboard.rank(urls)
+        tripped = self.scoreboard.tripped if self.scoreboard else None
+        tried = []
+        err = URLGrabError(-1, "no mirrors for %s" % po.repoid)
+        while len(tried) < len(urls):
+            url = self.slots.acquire([u for u in urls if u not in tried],
+                                     tripped)
+            if tried:
+                metrics.retry(po.repoid, tried[-1])
+            try:
+                start = time.time()
+                self._grab(po, url, local)
+                elapsed = time.time() - start
+                metrics.transfer(po.repoid, url, po.size, elapsed)
+                if self.scoreboard:
+                    self.scoreboard.record(url, size=po.size, elapsed=elapsed)
+                return url
+            except URLGrabError as e:
+                log.info("couldn't fetch %s from %s: %s", po, url, e)
+                metrics.transfer(po.repoid, url, elapsed=time.time()-start,
+                                 failed=True)
+                if self.scoreboard:
+                    self.scoreboard.record(url, failed=True)
+                err = e
+                tried.append(url)
+            finally:
+                self.slots.release(url)
+        raise err
+
+class DownloadPipeline(object):
+    '''
+    Download packages and check them as each download finishes.
+
+    Downloads run in the fetcher's pool of threads; each finished package
+    goes straight into a second pool that runs check(po) while the other
+    downloads continue. check(po) should return:
+
+      True  if the package is OK,
+      False if the file is bad and should be downloaded again,
+      None  if the package needs help that can't be given from a worker
+            thread (like importing a GPG key); it's left for the caller.
+    '''
+    def __init__(self, fetcher, check, checkers=None, retries=1):
+        self.fetcher = fetcher
+        self.check = check
+        self.checkers = checkers or cpu_count()
+        self.retries = retries
+
+    def _fetch_job(self, item):
+        return self.fetcher.fetch(item[1])
+
+    def _check_job(self, item):
+        return self.check(item[1])
+
+    def run(self, fetch, local=[], callback=None, done=None):
+        '''
+        Download the packages in fetch and check them, along with the
+        already-downloaded packages in local.
+
+        Returns (checked, failed): the packages that passed check(), and
+        the ones that couldn't be downloaded or kept failing check().
+        Packages where check() returned None are in neither list.
+
+        callback and done work like they do for PackageFetcher.download.
+        '''
+        checked, failed = [], []
+        tries = dict((po, 0) for po in fetch)
+        sources = dict() # po -> the mirror it came from
+        total, fetched = len(fetch), 0
+        results = Queue()
+        fetchpool = WorkerPool(self._fetch_job, self.fetcher.workers,
+                               name='fetch', results=results)
+        checkpool = WorkerPool(self._check_job, self.checkers,
+                               name='check', results=results)
+        pending = 0
+        try:
+            for po in fetch:
+                fetchpool.put(('fetch', po))
+                pending += 1
+            for po in local:
+                checkpool.put(('check', po))
+                pending += 1
+            while pending:
+                (stage, po), result, exc = qget(results)
+                pending -= 1
+                if stage == 'fetch':
+                    fetched += 1
+                    if exc:
+                        log.info("download of %s failed: %s", po, exc[1])
+                        failed.append(po)
+                    else:
+                        sources[po] = result
+                        if done:
+                            done(po)
+                        checkpool.put(('check', po))
+                        pending += 1
+                    if hasattr(callback, "download") and callable(callback.download):
+                        callback.download(fetched, total, po.localPkg(), exc)
+                    continue
+
+                if exc:
+                    log.info("checking %s failed: %s", po, exc[1])
+                elif result:
+                    checked.append(po)
+                    continue
+                elif result is None:
+                    log.debug("%s needs further checking", po)
+                    continue
+                # the file is bad. get it again, if we can.
+                log.info("%s is damaged; removing it", po.localPkg())
+                try:
+                    os.remove(po.localPkg())
+                except OSError:
+                    pass
+                if is_remote(po) and tries.get(po, 0) < self.retries:
+                    tries[po] = tries.get(po, 0) + 1
+                    metrics.retry(po.repoid, sources.get(po))
+                    total += 1
+                    fetchpool.put(('fetch', po))
+                    pending += 1
+                else:
+                    failed.append(po)
+        finally:
+            fetchpool.close()
+            checkpool.close()
+        return checked, failed
+
+class HeadRequest(urllib2.Request):
+    def get_method(self):
+        return 'HEAD'
+
+def remote_size(url, proxy=None, timeout=30):
+    '''
+    Ask the server how big url is. Returns (size, ranges), where ranges is
+    True if the server accepts byte-range requests. size is None if we
+    couldn't find out.
+    '''
+    handlers = []
+    if proxy and proxy != '_none_':
+        handlers.append(urllib2.ProxyHandler({'http':proxy, 'https':proxy}))
+    try:
+        resp = urllib2.build_opener(*handlers).open(HeadRequest(url),
+                                                    timeout=timeout)
+        info = resp.info()
+        size = int(info.getheader('Content-Length'))
+        ranges = (info.getheader('Accept-Ranges', '').lower() == 'bytes')
+        resp.close()
+    except (urllib2.URLError, IOError, ValueError, TypeError) as e:
+        log.debug("HEAD %s failed: %s", url, e)
+        return None, False
+    return size, ranges
+
+def fetch_segmented(grabfunc, urls, relpath, outfile, size, slots=None,
+                    segsize=32*1024*1024, workers=4, resume=True, hasher=None,
+                    repoid=None, cancel=None):
+    '''
+    Download relpath to outfile in byte-range segments of segsize, pulling
+    segments from all the mirrors in urls at once (limited by slots, a
+    MirrorSlots object). Each segment is written to its own file next to
+    outfile and the pieces are joined when they're all done.
+
+    If resume is True, segment files left over from an earlier attempt are
+    reused if they're the right size. Raises URLGrabError if a segment
+    couldn't be fetched from any mirror.
+
+    If hasher (a hashlib object) is given, the data is fed to it as the
+    pieces are joined. repoid is used for the transfer metrics.
+    If cancel (a threading.Event) gets set, raises Cancelled once the
+    segments in progress are done.
+    '''
+    threadsafe_urlgrabber()
+    slots = slots or MirrorSlots()
+    segfmt = outfile + '.seg%04u'
+    if not resume:
+        remove_segments(outfile)
+    segments = [(n, start, min(start+segsize, size))
+                for n, start in enumerate(range(0, size, segsize))]
+
+    def fetch_segment(seg):
+        n, start, end = seg
+        segfile = segfmt % n
+        if os.path.exists(segfile) and os.path.getsize(segfile) == end-start:
+            return segfile
+        tried = []
+        err = URLGrabError(-1, "no mirrors for %s" % relpath)
+        while len(tried) < len(urls):
+            check_cancel(cancel)
+            url = slots.acquire([u for u in urls if u not in tried])
+            if tried:
+                metrics.retry(repoid, tried[-1])
+            t = time.time()
+            try:
+                grabfunc.urlgrab(url.rstrip('/') + '/' + relpath, segfile,
+                                 range=(start, end), reget=None,
+                                 progress_obj=None, checkfunc=None)
+                if os.path.getsize(segfile) != end-start:
+                    raise URLGrabError(-1, "short read for %s bytes %u-%u"
+                                           % (relpath, start, end))
+                metrics.transfer(repoid, url, end-start, time.time()-t)
+                return segfile
+            except URLGrabError as e:
+                log.info("couldn't fetch %s segment %u from %s: %s",
+                         relpath, n, url, e)
+                metrics.transfer(repoid, url, elapsed=time.time()-t,
+                                 failed=True)
+                err = e
+                tried.append(url)
+            finally:
+                slots.release(url)
+        raise err
+
+    log.info("fetching %s in %u segments from %u mirrors",
+             relpath, len(segments), len(urls))
+    for seg, segfile, exc in pmap(fetch_segment, segments, workers,
+                                  name='segment'):
+        if exc:
+            raise exc[0], exc[1], exc[2]
+
+    with open(outfile, 'wb') as outf:
+        for n, start, end in segments:
+            with open(segfmt % n, 'rb') as inf:
+                copy_hashed(inf, outf, hasher)
+    remove_segments(outfile)
+    return outfile
+
+def copy_hashed(inf, outf, hasher=None, blocksize=256*1024, cancel=None):
+    '''copy everything from inf to outf, feeding it to hasher on the way.
+    raises Cancelled if cancel (a threading.Event) gets set.'''
+    if hasher is None and cancel is None:
+        return copyfileobj(inf, outf, blocksize)
+    while True:
+        check_cancel(cancel)
+        data = inf.read(blocksize)
+        if not data:
+            break
+        outf.write(data)
+        if hasher is not None:
+            hasher.update(data)
+
+def fetch_hashed(grab, relpath, outfile, hasher, resume=True, cancel=None,
+                 **kwargs):
+    '''
+    Download relpath to outfile using grab (a URLGrabber or MirrorGroup),
+    feeding the data to hasher as it gets written - so the file doesn't
+    need to be read again to check it.
+
+    If resume is True and outfile already has some data in it, that data
+    gets hashed and only the rest of the file is fetched.
+
+    Returns the url the data came from (or None if there was nothing left
+    to fetch). Raises Cancelled if cancel (a threading.Event) gets set.
+    '''
+    offset = 0
+    if resume and os.path.exists(outfile):
+        with open(outfile, 'rb') as inf:
+            for data in iter(lambda: inf.read(256*1024), ''):
+                hasher.update(data)
+            offset = inf.tell()
+    if offset:
+        log.debug("resuming %s at byte %u", relpath, offset)
+        kwargs['range'] = (offset, None)
+    try:
+        inf = grab.urlopen(relpath, **kwargs)
+    except URLGrabError as e:
+        # errno 9 means the range can't be satisfied: we've got it all
+        if offset and e.errno == 9:
+            return None
+        raise
+    try:
+        with open(outfile, 'ab' if offset else 'wb') as outf:
+            copy_hashed(inf, outf, hasher, cancel=cancel)
+    finally:
+        inf.close()
+    return getattr(inf, 'url', None)
+
+def remove_segments(outfile):
+    '''Clean up any segment files left behind by fetch_segmented.'''
+    for f in glob.glob(outfile + '.seg*'):
+        rm_f(f)
@@ -0,0 +1,171 @@
+# fileindex.py - find file conflicts without running a test transaction
+#
+# Copyright (C) 2026 The redhat-upgrade-tool contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import rpm
+import stat
+from array import array
+from bisect import bisect_left
+
+from .parallel import pmap
+
+import logging
+log = logging.getLogger(__package__+".fileindex")
+
+def nevra(hdr):
+    return hdr.sprintf('%{NAME}-%|EPOCH?{%{EPOCH}:}|%{VERSION}-%{RELEASE}.%{ARCH}')
+
+def fileinfo(hdr):
+    '''
+    Yield (path, mode, fingerprint, color, flags) for each file in hdr.
+    Files with the same fingerprint have the same mode, contents and link
+    target.
+    '''
+    for (path, mode, digest, linkto, color, flags) in zip(
+                hdr[rpm.RPMTAG_FILENAMES], hdr[rpm.RPMTAG_FILEMODES],
+                hdr[rpm.RPMTAG_FILEDIGESTS], hdr[rpm.RPMTAG_FILELINKTOS],
+                hdr[rpm.RPMTAG_FILECOLORS], hdr[rpm.RPMTAG_FILEFLAGS]):
+        yield path, mode & 0xffff, hash((mode, digest, linkto)), color, flags
+
+def files_conflict(amode, afp, acolor, bmode, bfp, bcolor):
+    '''
+    Do two files at the same path conflict? Identical files, directories
+    and files for different multilib colors (which rpm sorts out itself)
+    don't. Neither do %ghost files, but those never make it into the index.
+    '''
+    if acolor and bcolor and acolor != bcolor:
+        return False
+    if stat.S_ISDIR(amode) and stat.S_ISDIR(bmode):
+        return False
+    return afp != bfp
+
+def _index_package(item):
+    n, hdr = item
+    keys, filenums = array('l'), array('I')
+    modes, fps, colors = array('H'), array('l'), array('B')
+    for num, (path, mode, fp, color, flags) in enumerate(fileinfo(hdr)):
+        if flags & rpm.RPMFILE_GHOST:
+            continue
+        keys.append(hash(path))
+        filenums.append(num)
+        modes.append(mode)
+        fps.append(fp)
+        colors.append(color & 0xff)
+    return keys, filenums, modes, fps, colors
+
+class FileIndex(object):
+    '''
+    An index of every file in a set of packages, which can be checked for
+    file conflicts - with itself, or with the installed packages.
+
+    There can be a few hundred thousand files, so instead of a dict of
+    paths it's a handful of arrays sorted by the hash of the path, holding
+    (per file): the path hash, the package (as an index into self.headers),
+    the file's number in that package, its mode, a fingerprint of its
+    contents and its color. That's ~30 bytes per file, and the path
+    strings only get looked up when there's something to report.
+    '''
+    def __init__(self, headers, workers=4):
+        self.headers = list(headers)
+        log.debug("indexing files in %u packages", len(self.headers))
+        parts = [None] * len(self.headers)
+        for (n, hdr), result, exc in pmap(_index_package,
+                                          enumerate(self.headers),
+                                          workers, name='fileindex'):
+            if exc:
+                raise exc[0], exc[1], exc[2]
+            parts[n] = result
+        keys, pkgs, filenums = array('l'), array('I'), array('I')
+        modes, fps, colors = array('H'), array('l'), array('B')
+        for n, (k, fn, m, f, c) in enumerate(parts):
+            keys.extend(k)
+            pkgs.extend(array('I', [n]) * len(k))
+            filenums.extend(fn)
+            modes.extend(m)
+            fps.extend(f)
+            colors.extend(c)
+        del parts
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        self.keys = array('l', (keys[i] for i in order))
+        self.pkgs = array('I', (pkgs[i] for i in order))
+        self.filenums = array('I', (filenums[i] for i in order))
+        self.modes = array('H', (modes[i] for i in order))
+        self.fps = array('l', (fps[i] for i in order))
+        self.colors = array('B', (colors[i] for i in order))
+        log.debug("indexed %u files", len(self.keys))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def path(self, i):
+        '''the path of the i'th file in the index'''
+        hdr = self.headers[self.pkgs[i]]
+        return hdr[rpm.RPMTAG_FILENAMES][self.filenums[i]]
+
+    def _matches(self, key):
+        i = bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            yield i
+            i += 1
+
+    def conflicts(self):
+        '''
+        Find files that more than one of the indexed packages would install
+        with different contents. Yields (path, hdr, otherhdr) for each one.
+        '''
+        keys, pkgs = self.keys, self.pkgs
+        modes, fps, colors = self.modes, self.fps, self.colors
+        first = 0
+        for i in xrange(1, len(keys)):
+            if keys[i] != keys[first]:
+                first = i
+                continue
+            # check against everything before it with the same hash; there's
+            # hardly ever more than two or three of them
+            for j in xrange(first, i):
+                if pkgs[i] != pkgs[j] and \
+                        files_conflict(modes[i], fps[i], colors[i],
+                                       modes[j], fps[j], colors[j]):
+                    path = self.path(i)
+                    if path == self.path(j): # not just a hash collision
+                        yield (path, self.headers[pkgs[i]],
+                               self.headers[pkgs[j]])
+
+    def installed_conflicts(self, ts, skip=()):
+        '''
+        Compare the index with the files of the packages installed in the
+        rpmdb for ts (except the ones with db offsets in skip, i.e. the
+        ones that are going to be removed).
+        Yields (path, hdr, installedhdr) for each conflict.
+        '''
+        skip = set(skip)
+        mi = ts.dbMatch()
+        for ihdr in mi:
+            if mi.instance() in skip or ihdr[rpm.RPMTAG_NAME] == 'gpg-pubkey':
+                continue
+            states = ihdr[rpm.RPMTAG_FILESTATES] or []
+            if isinstance(states, str): # some rpm versions give us a string
+                states = [ord(s) for s in states]
+            for (path, mode, fp, color, flags), state in zip(fileinfo(ihdr),
+                                                             states):
+                if state != rpm.RPMFILE_STATE_NORMAL or \
+                        flags & rpm.RPMFILE_GHOST:
+                    continue
+                for i in self._matches(hash(path)):
+                    if files_conflict(self.modes[i], self.fps[i],
+                                      self.colors[i], mode, fp, color & 0xff) \
+                            and self.path(i) == path:
+                        yield path, self.headers[self.pkgs[i]], ihdr
@@ -0,0 +1,210 @@
+# metrics.py - keep track of where the time (and the bandwidth) goes
+#
+# Copyright (C) 2026 The redhat-upgrade-tool contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import json
+import time
+import threading
+from tempfile import mkstemp
+from contextlib import contextmanager
+
+from .mirrors import mirror_host
+from .util import mkdir_p
+
+import logging
+log = logging.getLogger(__package__+".metrics")
+
+prefix = 'redhat_upgrade_tool'
+
+class Histogram(object):
+    '''A Prometheus-style histogram: counts of values <= each bucket.'''
+    buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for n, le in enumerate(self.buckets):
+            if value <= le:
+                self.counts[n] += 1
+        self.sum += value
+        self.count += 1
+
+    def asdict(self):
+        b = dict(('%g' % le, c) for le, c in zip(self.buckets, self.counts))
+        b['+Inf'] = self.count
+        return {'buckets': b, 'sum': self.sum, 'count': self.count}
+
+class Transfers(object):
+    '''Counters for the transfers from one mirror for one repo.'''
+    def __init__(self):
+        self.bytes = 0
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.request_seconds = Histogram()
+
+    def asdict(self):
+        return {'bytes': self.bytes, 'requests': self.requests,
+                'failures': self.failures, 'retries': self.retries,
+                'seconds': self.seconds,
+                'throughput': self.bytes / self.seconds if self.seconds else 0,
+                'request_seconds': self.request_seconds.asdict()}
+
+class Metrics(object):
+    '''
+    Collects transfer stats (per repo and mirror) and the time spent in
+    each phase of the upgrade prep. Safe to use from several threads.
+
+    Only our own downloaders report transfers; things yum fetches by itself
+    get noted with untracked(), so the output can say the totals are
+    missing them.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.transfers = dict() # (repoid, mirror host) -> Transfers
+        self.phases = dict()    # phase name -> seconds
+        self.missing = set()    # kinds of downloads the transfers don't cover
+
+    def _get(self, repoid, url):
+        key = (repoid or 'unknown', mirror_host(url) if url else 'unknown')
+        if key not in self.transfers:
+            self.transfers[key] = Transfers()
+        return self.transfers[key]
+
+    def transfer(self, repoid, url, size=0, elapsed=0.0, failed=False):
+        '''record one request to url for repoid, which took elapsed seconds
+        and got size bytes (or failed).'''
+        with self.lock:
+            t = self._get(repoid, url)
+            t.requests += 1
+            t.seconds += elapsed
+            t.request_seconds.observe(elapsed)
+            if failed:
+                t.failures += 1
+            else:
+                t.bytes += size
+
+    def retry(self, repoid, url):
+        '''record that something from url had to be fetched again'''
+        with self.lock:
+            self._get(repoid, url).retries += 1
+
+    def untracked(self, what):
+        '''note that some downloads (described by what) weren't recorded'''
+        with self.lock:
+            self.missing.add(what)
+
+    @contextmanager
+    def phase(self, name):
+        '''time the code in a 'with' block as the given phase'''
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed
+            log.debug("phase %s took %.3fs", name, elapsed)
+
+    def summary(self):
+        with self.lock:
+            transfers = [dict(repo=repo, mirror=mirror, **t.asdict())
+                         for (repo, mirror), t in sorted(self.transfers.items())]
+            return {'start': self.start, 'elapsed': time.time() - self.start,
+                    'phases': dict(self.phases), 'transfers': transfers,
+                    'partial': bool(self.missing),
+                    'untracked': sorted(self.missing)}
+
+    def prometheus(self):
+        '''the metrics in Prometheus text exposition format'''
+        s = self.summary()
+        lines = []
+        def metric(name, mtype, helptext, samples):
+            lines.append('# HELP %s_%s %s' % (prefix, name, helptext))
+            lines.append('# TYPE %s_%s %s' % (prefix, name, mtype))
+            for suffix, labels, value in samples:
+                labelstr = ','.join('%s="%s"' % (k, escape(v))
+                                    for k, v in labels)
+                if labelstr:
+                    labelstr = '{%s}' % labelstr
+                lines.append('%s_%s%s%s %s' % (prefix, name, suffix,
+                                               labelstr, value))
+        def counter(field, helptext, mtype='counter'):
+            metric(field, mtype, helptext,
+                   [('', (('repo', t['repo']), ('mirror', t['mirror'])),
+                     t[field.replace('_total', '')]) for t in s['transfers']])
+        counter('bytes_total', 'Bytes downloaded.')
+        counter('requests_total', 'Download requests made.')
+        counter('failures_total', 'Download requests that failed.')
+        counter('retries_total', 'Files that had to be downloaded again.')
+        counter('seconds_total', 'Time spent downloading.')
+        counter('throughput', 'Average download speed in bytes/second.',
+                mtype='gauge')
+        samples = []
+        for t in s['transfers']:
+            labels = (('repo', t['repo']), ('mirror', t['mirror']))
+            h = t['request_seconds']
+            for le in [('%g' % b) for b in Histogram.buckets] + ['+Inf']:
+                samples.append(('_bucket', labels + (('le', le),),
+                                h['buckets'][le]))
+            samples.append(('_sum', labels, h['sum']))
+            samples.append(('_count', labels, h['count']))
+        metric('request_seconds', 'histogram',
+               'How long each download request took.', samples)
+        metric('transfers_partial', 'gauge',
+               'Whether the transfer totals are missing some downloads.',
+               [('', (), int(s['partial']))])
+        metric('untracked_downloads', 'gauge',
+               'Kinds of downloads the transfer totals leave out.',
+               [('', (('what', what),), 1) for what in s['untracked']])
+        metric('phase_seconds', 'gauge', 'Time spent in each phase.',
+               [('', (('phase', name),), secs)
+                for name, secs in sorted(s['phases'].items())])
+        metric('elapsed_seconds', 'gauge', 'Total run time.',
+               [('', (), s['elapsed'])])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, dirname, name='redhat-upgrade-tool'):
+        '''write name.json and name.prom (for the node_exporter textfile
+        collector) into dirname'''
+        try:
+            mkdir_p(dirname)
+            atomic_write(os.path.join(dirname, name+'.json'),
+                         json.dumps(self.summary(), indent=1))
+            atomic_write(os.path.join(dirname, name+'.prom'),
+                         self.prometheus())
+        except (IOError, OSError) as e:
+            log.warn("couldn't write metrics to %s: %s", dirname, str(e))
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def atomic_write(filename, data):
+    fd, tmp = mkstemp(dir=os.path.dirname(filename),
+                      prefix='.'+os.path.basename(filename))
+    with os.fdopen(fd, 'w') as outf:
+        outf.write(data)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, filename)
+
+# the collector everything reports to
+metrics = Metrics()
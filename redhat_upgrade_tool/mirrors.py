@@ -0,0 +1,166 @@
+# mirrors.py - keep score of how well mirrors work and rank them
+#
+# Copyright (C) 2026 The redhat-upgrade-tool contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+import urllib2
+from urlparse import urlparse
+
+from .cache import JSONCache
+from .parallel import pmap
+
+import logging
+log = logging.getLogger(__package__+".mirrors")
+
+def mirror_host(url):
+    '''mirrors get scored per-host, since one host serves lots of repos'''
+    return urlparse(url).netloc or url
+
+def is_network_url(url):
+    return url.startswith(('http:', 'https:', 'ftp:'))
+
+class MirrorScoreboard(JSONCache):
+    '''
+    Keeps track of how fast and how reliable each mirror has been.
+
+    Each entry is: host: {'samples': n, 'latency': secs, 'throughput': B/s,
+                          'failrate': 0..1, 'failures': consecutive failures,
+                          'stamp': time of last update, 'skip_until': time}
+
+    latency, throughput and failrate are weighted averages where the weight
+    of old samples halves every 'halflife' seconds, so a mirror that was
+    slow last week doesn't stay at the bottom of the list forever.
+
+    A mirror that fails 'trip' times in a row gets skipped for 'cooldown'
+    seconds (it's still tried if every other mirror fails, though).
+    '''
+    halflife = 24*60*60
+    trip = 3
+    cooldown = 30*60
+    # cost of a typical fetch, for comparing latency against throughput
+    typical_size = 1024*1024
+
+    def _entry(self, host, now):
+        ent = self.data.setdefault(host, {'samples': 0.0, 'latency': None,
+                                          'throughput': None, 'failrate': 0.0,
+                                          'failures': 0, 'stamp': now,
+                                          'skip_until': 0})
+        # age the old samples
+        ent['samples'] *= 0.5 ** (max(0, now - ent['stamp']) / self.halflife)
+        ent['stamp'] = now
+        return ent
+
+    @staticmethod
+    def _average(old, new, n):
+        if old is None or n <= 0:
+            return new
+        return (old*n + new) / (n+1)
+
+    def record(self, url, latency=None, size=0, elapsed=None, failed=False):
+        '''
+        Record the result of one fetch from the mirror at url: how long
+        until it started answering, and how many bytes it sent in how many
+        seconds. Or that it failed.
+        '''
+        now = time.time()
+        with self.lock:
+            ent = self._entry(mirror_host(url), now)
+            n = ent['samples']
+            ent['failrate'] = self._average(ent['failrate'], float(failed), n)
+            if failed:
+                ent['failures'] += 1
+                if ent['failures'] >= self.trip:
+                    log.info("%s failed %u times in a row; skipping it for "
+                             "a while", mirror_host(url), ent['failures'])
+                    ent['skip_until'] = now + self.cooldown
+            else:
+                ent['failures'] = 0
+                ent['skip_until'] = 0
+                if latency is not None:
+                    ent['latency'] = self._average(ent['latency'], latency, n)
+                if size and elapsed:
+                    ent['throughput'] = self._average(ent['throughput'],
+                                                      size/elapsed, n)
+            ent['samples'] = n + 1
+            self.dirty = True
+
+    def tripped(self, url, now=None):
+        '''True if the mirror at url is cooling down after too many failures'''
+        with self.lock:
+            ent = self.data.get(mirror_host(url))
+        return bool(ent) and ent['skip_until'] > (now or time.time())
+
+    def cost(self, url):
+        '''
+        Roughly how long we'd expect a typical fetch from this mirror to take,
+        counting failed attempts. None if we don't know anything about it.
+        '''
+        with self.lock:
+            ent = self.data.get(mirror_host(url))
+        if not ent or ent['latency'] is None:
+            return None
+        cost = ent['latency']
+        if ent['throughput']:
+            cost += self.typical_size / ent['throughput']
+        failrate = min(ent['failrate'], 0.99)
+        return cost / (1 - failrate)
+
+    def rank(self, urls):
+        '''
+        Sort urls best-first. Mirrors we don't know anything about go after
+        the ones we know are working, and tripped mirrors go last. Otherwise
+        the original order is kept.
+        '''
+        now = time.time()
+        def key(url):
+            cost = self.cost(url)
+            return (self.tripped(url, now), cost is None, cost)
+        return sorted(urls, key=key)
+
+def probe_mirror(url, proxy=None, timeout=10):
+    '''
+    Fetch repomd.xml from the repo at url. Returns (latency, size, elapsed),
+    where latency is the time it took to get the response headers.
+    Raises IOError (or a subclass) if the fetch failed.
+    '''
+    handlers = []
+    if proxy and proxy != '_none_':
+        handlers.append(urllib2.ProxyHandler({'http':proxy, 'https':proxy,
+                                              'ftp':proxy}))
+    start = time.time()
+    resp = urllib2.build_opener(*handlers).open(
+                            url.rstrip('/') + '/repodata/repomd.xml',
+                            timeout=timeout)
+    latency = time.time() - start
+    try:
+        size = len(resp.read())
+    finally:
+        resp.close()
+    return latency, size, time.time() - start
+
+def probe_mirrors(scoreboard, urls, proxy=None, workers=8):
+    '''Probe all the given mirrors at once and record the results.'''
+    def probe(url):
+        return probe_mirror(url, proxy)
+    for url, result, exc in pmap(probe, urls, workers, name='mirrorprobe'):
+        if exc:
+            log.debug("probe of %s failed: %s", url, exc[1])
+            scoreboard.record(url, failed=True)
+        else:
+            latency, size, elapsed = result
+            log.debug("probe of %s: latency %.3fs, %u bytes in %.3fs",
+                      url, latency, size, elapsed)
+            scoreboard.record(url, latency, size, elapsed)
@@ -0,0 +1,246 @@
+# parallel.py - helpers for doing things concurrently
+#
+# Copyright (C) 2026 The redhat-upgrade-tool contributors
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, sys, signal
+import threading
+import multiprocessing
+from threading import Thread
+from Queue import Queue, Empty
+
+import logging
+log = logging.getLogger(__package__+".parallel")
+
+def qget(queue):
+    '''Queue.get() that can still be interrupted by ^C.
+    (In python2 a blocking get() with no timeout ignores KeyboardInterrupt.)'''
+    while True:
+        try:
+            return queue.get(True, 0.5)
+        except Empty:
+            continue
+
+_stop = object()
+
+class WorkerPool(object):
+    '''
+    A pool of worker threads that call func(item) for each item put into
+    the pool. Each finished item gives a result tuple:
+
+      (item, result, exc_info)
+
+    exc_info is None if func returned normally; otherwise it's the
+    sys.exc_info() for the exception func raised (and result is None).
+    Results come back in the order the items *finish*, not the order they
+    were put in.
+
+    Items can be added while results are being consumed, so a consumer can
+    put an item back into the pool to retry it.
+
+    Several pools can share one results queue; in that case the consumer
+    should read the queue itself rather than iterating over the pool.
+    '''
+    def __init__(self, func, workers=4, name='worker', results=None):
+        self.func = func
+        self.jobs = Queue()
+        self.results = Queue() if results is None else results
+        self.pending = 0
+        self.threads = []
+        for n in range(max(1, workers)):
+            t = Thread(target=self._run, name='%s-%u' % (name, n))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _run(self):
+        while True:
+            item = self.jobs.get()
+            if item is _stop:
+                break
+            try:
+                result = self.func(item)
+            except Exception:
+                self.results.put((item, None, sys.exc_info()))
+            else:
+                self.results.put((item, result, None))
+
+    def put(self, item):
+        self.pending += 1
+        self.jobs.put(item)
+
+    def __iter__(self):
+        while self.pending:
+            res = qget(self.results)
+            self.pending -= 1
+            yield res
+
+    def close(self):
+        '''Stop the workers. Any jobs that haven't been started are dropped.'''
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except Empty:
+            pass
+        for t in self.threads:
+            self.jobs.put(_stop)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def pmap(func, items, workers=4, name='worker'):
+    '''Like map(), but runs func in a pool of threads and yields
+    (item, result, exc_info) tuples as each item finishes.'''
+    with WorkerPool(func, workers, name) as pool:
+        for item in items:
+            pool.put(item)
+        for res in pool:
+            yield res
+
+class Phase(object):
+    '''
+    One phase of the upgrade prep, run in a background thread so it can
+    overlap with other phases. join() waits for it to finish and then
+    returns its result or raises its exception, so calling join() is just
+    like calling func(*args, **kwargs) yourself - only later.
+
+    Phases listed in 'after' are joined before func starts; if one of them
+    fails, this phase fails the same way.
+
+    If func can be stopped early, pass the threading.Event it watches as
+    'stop', and cancel() will use it.
+    '''
+    def __init__(self, name, func, args=(), kwargs={}, after=(), stop=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.after = after
+        self.stop = stop
+        self.result = None
+        self.exc_info = None
+        self.thread = Thread(target=self._run, name=name)
+        self.thread.daemon = True
+
+    def _run(self):
+        try:
+            for phase in self.after:
+                phase.join()
+            log.debug("phase %s starting", self.name)
+            self.result = self.func(*self.args, **self.kwargs)
+            log.debug("phase %s finished", self.name)
+        except BaseException:
+            self.exc_info = sys.exc_info()
+            log.debug("phase %s failed: %s", self.name, self.exc_info[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def wait(self):
+        # join with a timeout, so ^C still works (see qget)
+        while self.thread.is_alive():
+            self.thread.join(0.5)
+
+    def join(self):
+        self.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+    def cancel(self):
+        '''Stop the phase (if it has a 'stop' event) and wait for it to
+        finish. Its result - or exception - is thrown away.'''
+        if self.stop is not None:
+            self.stop.set()
+        if self.thread.ident is not None:
+            self.wait()
+
+def _ignore_sigint():
+    # let the parent process handle ^C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def process_map(func, items, processes=None, chunksize=8):
+    '''
+    Run func(item) for each item in a pool of worker processes and yield
+    the results as they finish (in no particular order). func must be a
+    module-level function and items/results must be picklable.
+    processes defaults to the number of CPUs.
+    '''
+    pool = multiprocessing.Pool(processes, initializer=_ignore_sigint)
+    try:
+        results = pool.imap_unordered(func, items, chunksize)
+        while True:
+            try:
+                # a timeout keeps this interruptible, just like qget()
+                yield results.next(0.5)
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+def checksum_file(job):
+    '''
+    Worker function for process_map: job is (filename, algo, size).
+    Returns (filename, stat, hexdigest), where stat is the result of
+    os.stat(filename) *before* it was read and hexdigest is None if the file
+    couldn't be read.
+    '''
+    from yum.misc import checksum
+    from yum.Errors import MiscError
+    filename, algo, size = job
+    try:
+        st = os.stat(filename)
+        return filename, st, checksum(algo, filename, datasize=size)
+    except (OSError, MiscError):
+        return filename, None, None
+
+# urlgrabber's pycurl backend keeps one module-global curl handle and reuses
+# it for every request. That's fine when everything happens in one thread,
+# but it's a disaster when several threads start downloading at once. So:
+# replace it with a proxy that gives each thread its own handle.
+class ThreadLocalCurl(threading.local):
+    def __init__(self):
+        import pycurl
+        self.curl = pycurl.Curl()
+
+    def __getattr__(self, attr):
+        return getattr(self.curl, attr)
+
+def threadsafe_urlgrabber():
+    from urlgrabber import grabber
+    if not hasattr(grabber, '_curl_cache'):
+        return # not the pycurl backend; nothing to fix
+    if isinstance(grabber._curl_cache, ThreadLocalCurl):
+        return
+    log.debug("setting up per-thread curl handles")
+    grabber._curl_cache = ThreadLocalCurl()
+    # reset_curl_obj() would put a single shared handle back. Don't let it.
+    def reset_curl_obj():
+        grabber._curl_cache = ThreadLocalCurl()
+    grabber.reset_curl_obj = reset_curl_obj
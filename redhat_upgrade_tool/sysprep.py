@@ -17,7 +17,7 @@
 #
 # Author: Will Woods <wwoods@redhat.com>
 
-import os
+import os, glob
 from shutil import copy2
 
 from . import _
@@ -27,6 +27,7 @@ from .media import write_systemd_unit
 from .util import listdir, mkdir_p, rm_f, rm_rf, is_selinux_enabled, kernelver
 from .conf import Config
 from . import boot
+from . import bundle
 
 import logging
 log = logging.getLogger(__package__+".sysprep")
@@ -53,7 +54,8 @@ def link_pkgs(pkgs):
     pkgbasenames = set()
     for pkg in pkgs:
         pkgpath = pkg.localPkg()
-        if pkg.remote_url.startswith("file://"):
+        if pkg.remote_url.startswith("file://") and \
+                not pkg.repoid.startswith(bundle.REPO_PREFIX):
             pkgbasename = "media/%s" % pkg.relativepath
             pkgbasenames.add(pkgbasename)
             continue
@@ -187,10 +189,12 @@ def remove_boot():
     conf = Config(upgradeconf)
     kernel = conf.get("boot", "kernel")
     initrd = conf.get("boot", "initrd")
-    if kernel:
-        rm_f(kernel)
-    if initrd:
-        rm_f(initrd)
+    for f in (kernel, initrd):
+        if f:
+            rm_f(f)
+            # partial downloads, too
+            for part in glob.glob(f + '.part*'):
+                rm_f(part)
 
 def remove_cache():
     '''remove our cache dirs'''
@@ -115,6 +115,7 @@ class DownloadCallback(DownloadCallbackBase):
     def __init__(self, tty=sys.stderr):
         DownloadCallbackBase.__init__(self)
         self.bar = SimpleProgress(10, tty=tty, prefix=_("verify local files"))
+        self.dlbar = SimpleProgress(10, tty=tty, prefix=_("downloading packages"))
 
     def verify(self, amount, total, filename, data):
         DownloadCallbackBase.verify(self, amount, total, filename, data)
@@ -124,6 +125,14 @@ class DownloadCallback(DownloadCallbackBase):
         if amount == total:
             self.bar.finish()
 
+    def download(self, amount, total, filename, data):
+        DownloadCallbackBase.download(self, amount, total, filename, data)
+        if self.dlbar.maxval != total:
+            self.dlbar.maxval = total
+        self.dlbar.update(amount)
+        if amount == total:
+            self.dlbar.finish()
+
 class TransactionCallback(RPMTsCallback):
     def __init__(self, numpkgs=0, tty=sys.stderr, prefix="rpm"):
         RPMTsCallback.__init__(self)
@@ -105,6 +105,7 @@ Some details about the file format:
 import ConfigParser
 from ConfigParser import RawConfigParser
 import hashlib
+import os
 import time
 from os.path import join, normpath
 import logging
@@ -146,6 +147,8 @@ class Treeinfo(RawConfigParser):
         '''
         RawConfigParser.__init__(self, allow_no_value=True)
         self._fullpath = dict() # save relpath -> filename mappings here
+        # optional index of already-verified files; see checkfile()
+        self.verified = None
         if hasattr(fromfile, 'readline'):
             self.readfp(fromfile)
         elif fromfile is not None:
@@ -183,6 +186,12 @@ class Treeinfo(RawConfigParser):
             self.get('general', f)
         # TODO check for checksums for all images
 
+    def get_checksum(self, relpath):
+        '''return (algo, hexdigest) for relpath from the [checksums] section'''
+        val = self.get('checksums', relpath)
+        algo, checksum = val.split(':',1)
+        return algo, checksum
+
     def checkfile(self, filename, relpath):
         '''
         Check the given file against the info in [checksum].
@@ -191,13 +200,22 @@ class Treeinfo(RawConfigParser):
         relpath is the relative path that was used to fetch the file,
         i.e. the value from the [images-*] section (and the key in the
         [checksums] section)
+
+        If self.verified is set to an index of verified files (something with
+        check() and record() methods, like cache.VerifiedIndex), a file that
+        hasn't changed since it was last verified isn't read again.
         '''
-        val = self.get('checksums', relpath)
-        algo, checksum = val.split(':',1)
+        algo, checksum = self.get_checksum(relpath)
+        if self.verified and self.verified.check(filename, algo, checksum):
+            return True
         try:
-            return checksum == hexdigest(filename, algo)
-        except IOError:
+            st = os.stat(filename)
+            ok = (checksum == hexdigest(filename, algo))
+        except (IOError, OSError):
             return False
+        if ok and self.verified:
+            self.verified.record(filename, algo, checksum, st)
+        return ok
 
     def add_image(self, arch, imgtype, relpath, topdir=None, algo='sha256'):
         '''
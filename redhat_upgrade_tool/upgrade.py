@@ -23,13 +23,16 @@ import rpm
 from rpm._rpm import ts as TransactionSetCore
 
 import os, tempfile
+import threading
 from threading import Thread
 
 import logging
 log = logging.getLogger(__package__+'.upgrade')
 
 from . import _
-from .util import df, hrsize
+from .util import df, hrsize, fadvise
+from .parallel import pmap, Phase
+from .fileindex import FileIndex, nevra
 
 class TransactionSet(TransactionSetCore):
     flags = TransactionSetCore._flags
@@ -58,12 +61,136 @@ class TransactionSet(TransactionSetCore):
             retval, header = self.hdrFromFdno(fileobj)
         if retval != rpm.RPMRC_OK:
             raise rpm.error("error reading package header")
+        self.add_header(header, key, upgrade)
+
+    def add_header(self, header, key, upgrade=False):
         if not self.addInstall(header, key, upgrade):
             raise rpm.error("adding package to transaction failed")
 
     def __del__(self):
         self.closeDB()
 
+# how much of each package to read ahead; that should cover the header
+HEADER_READAHEAD = 512*1024
+
+_tls = threading.local()
+def read_header(path, cache=None):
+    '''
+    Read the header from the package at path. Safe to call from worker
+    threads (each thread gets its own transaction set).
+    If cache (a HeaderCache) is given, the header gets saved there.
+    Raises rpm.error if the header can't be read.
+    '''
+    ts = getattr(_tls, 'ts', None)
+    if ts is None:
+        ts = _tls.ts = TransactionSetCore('/', rpm._RPMVSF_NOSIGNATURES)
+    with open(path) as fileobj:
+        st = os.fstat(fileobj.fileno())
+        retval, header = ts.hdrFromFdno(fileobj)
+    if retval != rpm.RPMRC_OK:
+        raise rpm.error("error reading package header")
+    if cache is not None:
+        cache.put(path, header.unload(), st)
+    return header
+
+def cached_header(path, cache):
+    '''Return the header for path from cache, or None if it's not there.'''
+    blob = cache.get(path)
+    if blob is None:
+        return None
+    try:
+        return rpm.headerLoad(blob)
+    except (rpm.error, TypeError) as e:
+        log.debug("bad cached header for %s: %s", path, e)
+        return None
+
+def prefetch_headers(paths, workers=4, cache=None, known=None):
+    '''
+    Read the headers of all the packages in paths at once, in a pool of
+    threads. Returns a dict of {path: header}; packages with unreadable
+    headers are logged and left out.
+    known is a dict of {path: header} for headers we've already got
+    (e.g. from checking signatures), which don't need reading at all.
+    If cache (a HeaderCache) is given, headers are loaded from it when
+    possible, and the rest get added to it.
+    '''
+    headers = dict((p, known[p]) for p in paths if known and p in known)
+    if headers:
+        log.debug("%u of %u headers already loaded", len(headers), len(paths))
+        if cache is not None:
+            for path, hdr in headers.items():
+                if not cache.has(path):
+                    cache.put(path, hdr.unload())
+        paths = [p for p in paths if p not in headers]
+    if cache is not None:
+        cached = 0
+        for path in paths:
+            hdr = cached_header(path, cache)
+            if hdr is not None:
+                headers[path] = hdr
+                cached += 1
+        log.debug("%u of %u headers were cached", cached, len(paths))
+        paths = [p for p in paths if p not in headers]
+    # tell the kernel what we're about to read, so the I/O can get started
+    # (and sorted sensibly) before the workers get there
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            fadvise(fd, 0, HEADER_READAHEAD)
+        finally:
+            os.close(fd)
+    def read(path):
+        return read_header(path, cache)
+    for path, hdr, exc in pmap(read, paths, workers, name='header'):
+        if exc:
+            log.warn('error adding pkg: %s', exc[1])
+        else:
+            headers[path] = hdr
+    return headers
+
+class Problem(object):
+    '''
+    A problem we found ourselves, rather than one from rpm. It looks enough
+    like an rpm.prob for summarize_problems() to handle it.
+    '''
+    def __init__(self, probtype, pkgNEVR, altNEVR='', key=None, _str='', _num=0):
+        self.type = probtype
+        self.pkgNEVR = pkgNEVR
+        self.altNEVR = altNEVR
+        self.key = key
+        self._str = _str
+        self._num = _num
+
+    def __str__(self):
+        if self.type in (rpm.RPMPROB_FILE_CONFLICT,
+                         rpm.RPMPROB_NEW_FILE_CONFLICT):
+            return "file %s from install of %s conflicts with file from " \
+                   "package %s" % (self._str, self.pkgNEVR, self.altNEVR)
+        elif self.type == rpm.RPMPROB_DISKSPACE:
+            return "installing needs %s more space on the %s filesystem" % \
+                   (hrsize(self._num), self._str)
+        return "%s: %s %s" % (probtypes.get(self.type), self.pkgNEVR, self._str)
+
+def file_conflicts(index, ts=None, removed=()):
+    '''
+    Find file conflicts between the packages in index (a FileIndex) and,
+    if ts is given, between them and the packages installed in its rpmdb
+    (except the ones with the db offsets in removed).
+    Returns a list of Problems, like the ones rpm would report.
+    '''
+    problems = [Problem(rpm.RPMPROB_NEW_FILE_CONFLICT, nevra(hdr),
+                        nevra(other), _str=path)
+                for path, hdr, other in index.conflicts()]
+    if ts is not None:
+        problems += [Problem(rpm.RPMPROB_FILE_CONFLICT, nevra(hdr),
+                             nevra(other), _str=path)
+                     for path, hdr, other in
+                         index.installed_conflicts(ts, removed)]
+    return problems
+
 probtypes = { rpm.RPMPROB_NEW_FILE_CONFLICT : _('file conflicts'),
               rpm.RPMPROB_FILE_CONFLICT : _('file conflicts'),
               rpm.RPMPROB_OLDPACKAGE: _('older package(s)'),
@@ -137,6 +264,20 @@ class DepProblemSummary(ProblemSummary):
         return [_("%s requires %s") % (pkg, ", ".join(pkgprob))
                  for (pkg, pkgprob) in self.details.iteritems()]
 
+class FileConflictProblemSummary(ProblemSummary):
+    def get_details(self):
+        # pkgprobs['newpkg'] = {'otherpkg': set([path1, path2, ...]), ...}
+        pkgprobs = dict()
+        for p in self.problems:
+            others = pkgprobs.setdefault(p.pkgNEVR, dict())
+            others.setdefault(p.altNEVR, set()).add(p._str)
+        return pkgprobs
+
+    def format_details(self):
+        return [_("%s conflicts with %s: %s") % (pkg, other, ", ".join(sorted(paths)))
+                 for (pkg, others) in sorted(self.details.iteritems())
+                 for (other, paths) in sorted(others.iteritems())]
+
 # If there is no handler for a type of problem, just return the
 # rpmProblemString result for the problems
 class GenericProblemSummary(ProblemSummary):
@@ -145,6 +286,8 @@ class GenericProblemSummary(ProblemSummary):
 
 probsummary = { rpm.RPMPROB_DISKSPACE: DiskspaceProblemSummary,
                 rpm.RPMPROB_REQUIRES:  DepProblemSummary,
+                rpm.RPMPROB_FILE_CONFLICT: FileConflictProblemSummary,
+                rpm.RPMPROB_NEW_FILE_CONFLICT: FileConflictProblemSummary,
               }
 
 
@@ -184,21 +327,38 @@ class RPMUpgrade(object):
     def __init__(self, root='/', logpipe=True, rpmloglevel=logging.INFO):
         self.root = root
         self.ts = None
+        self.headers = dict()
+        self.fileindex = None
         self.logpipe = None
         rpm.setVerbosity(logging_to_rpm[rpmloglevel])
         if logpipe:
             self.logpipe = self.openpipe()
 
-    def setup_transaction(self, pkgfiles, check_fatal=False):
+    def setup_transaction(self, pkgfiles, check_fatal=False, workers=4,
+                          headercache=None, headers=None, index_files=False):
         log.debug("starting")
         # initialize a transaction set
         self.ts = TransactionSet(self.root, rpm._RPMVSF_NOSIGNATURES)
         if self.logpipe:
             self.ts.scriptFd = self.logpipe.fileno()
+        # read all the headers at once, then add them in a predictable order
+        pkgfiles = sorted(pkgfiles)
+        headers = self.headers = prefetch_headers(pkgfiles, workers,
+                                                  headercache, headers)
+        if headercache is not None:
+            headercache.prune(pkgfiles)
+            headercache.save()
+        # index the files while rpm checks the transaction
+        if index_files:
+            self.fileindex = Phase('fileindex', FileIndex,
+                args=([headers[p] for p in pkgfiles if p in headers], workers))
+            self.fileindex.start()
         # populate the transaction set
         for pkg in pkgfiles:
+            if pkg not in headers:
+                continue # already logged; TODO: error callback
             try:
-                self.ts.add_install(pkg, upgrade=True)
+                self.ts.add_header(headers[pkg], pkg, upgrade=True)
             except rpm.error as e:
                 log.warn('error adding pkg: %s', e)
                 # TODO: error callback
@@ -219,6 +379,41 @@ class RPMUpgrade(object):
         if problems:
             return TransactionError(problems=problems)
 
+    def removed_offsets(self):
+        '''the db offsets of the installed packages the transaction removes'''
+        return [te.DBOffset() for te in self.ts if te.Type() == rpm.TR_REMOVED]
+
+    def removed_headers(self):
+        '''the headers of the installed packages the transaction removes'''
+        removed = []
+        for offset in self.removed_offsets():
+            for hdr in self.ts.dbMatch(rpm.RPMDBI_PACKAGES, offset):
+                removed.append(hdr)
+        return removed
+
+    def preflight(self, pkgfiles, workers=4, headercache=None, headers=None):
+        '''
+        A quick check of the transaction, without actually running it in
+        test mode: dependencies, file conflicts (between the new packages
+        and with the installed ones), and whether there's enough disk space.
+        Returns a list of problems, like the 'problems' of a TransactionError.
+        '''
+        from .diskspace import DiskPlan, plan_headers # (that one uses yum)
+        err = self.setup_transaction(pkgfiles, workers=workers,
+                                     headercache=headercache, headers=headers,
+                                     index_files=True)
+        problems = list(err.problems) if err else []
+        log.debug('checking for file conflicts')
+        problems += file_conflicts(self.fileindex.join(), self.ts,
+                                   self.removed_offsets())
+        log.debug('checking disk space')
+        plan = plan_headers(self.headers.values(), self.removed_headers(),
+                            DiskPlan())
+        for mnt, need, avail in plan.shortfalls():
+            problems.append(Problem(rpm.RPMPROB_DISKSPACE, '',
+                                    _str=mnt, _num=need-avail))
+        return problems
+
     def openpipe(self):
         log.debug("creating log pipe")
         pipefile = tempfile.mktemp(prefix='rpm-log-pipe.')
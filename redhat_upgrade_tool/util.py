@@ -31,6 +31,20 @@ try:
 except (ImportError, AttributeError, OSError):
     is_selinux_enabled = lambda: False
 
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+try:
+    from ctypes import cdll, c_int, c_int64
+    libc = cdll.LoadLibrary("libc.so.6")
+    _fadvise = libc.posix_fadvise64
+    _fadvise.argtypes = (c_int, c_int64, c_int64, c_int)
+    _fadvise.restype = c_int
+    def fadvise(fd, offset=0, length=0, advice=POSIX_FADV_WILLNEED):
+        '''hint to the kernel about how we're going to read fd'''
+        return _fadvise(fd, offset, length, advice)
+except (ImportError, AttributeError, OSError):
+    fadvise = lambda fd, offset=0, length=0, advice=0: 0
+
 def listdir(d):
     for f in os.listdir(d):
         yield os.path.join(d, f)